@@ -14,33 +14,73 @@ __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 
 from datetime import datetime
+from datetime import timedelta
+import hashlib
+import json
+import operator
+import random
+import time
+import uuid
+from collections import OrderedDict
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protobuf
 from protorpc import remote
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 from models import ConflictException
 from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
+from models import Registration
+from models import RegistrationClaim
+from models import IdempotencyRecord
+from models import ClaimBatch
+from models import WaitlistEntry
+from models import HoldForm
+from models import BulkRegistrationForm
+from models import RegistrationOutcome
+from models import RegistrationResultForm
+from models import RegistrationResultForms
+from models import ClaimStatus
+from models import ClaimForm
 from models import StringMessage
 from models import BooleanMessage
 from models import Conference
+from models import SeatShard
 from models import ConferenceForm
 from models import ConferenceForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
+from models import ConferenceSummaryForm
+from models import ConferenceSummaryForms
+from models import ConferenceFacet
+from models import FacetValueForm
+from models import FacetForm
+from models import FacetForms
 from models import TeeShirtSize
 
 from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
 from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
+from settings import USE_FILTER_ENGINE
+
+from converters import converterFor
+from keycache import keyFromUrlsafe
+from keycache import urlsafeFromKey
+from filterengine import ConferenceFilterEngine
+import indexadvisor
+import txstats
+from streaming import STREAM_BATCH_SIZE
+from streaming import STREAM_PAGE_SIZE
 
 from utils import getUserId
 
@@ -49,6 +89,50 @@ API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
+ORGANIZER_NAME_BATCH_SIZE = 100
+REGISTRATION_BACKFILL_BATCH_SIZE = 100
+MEMCACHE_CONFERENCES_GENERATION_KEY = "CONFERENCES_GENERATION"
+MEMCACHE_QUERY_KEY_TPL = "QUERY_CONFERENCES:%s"
+MEMCACHE_FACETS_KEY_TPL = "FACET_CONFERENCES:%s"
+MEMCACHE_SUMMARY_KEY_TPL = "SUMMARY_CONFERENCES:%s"
+MEMCACHE_CONFERENCE_VERSION_TPL = "CONFERENCE_VERSION:%s"
+MEMCACHE_CONFERENCE_FORM_TPL = "CONFERENCE_FORM:%s"
+MEMCACHE_SEATS_TPL = "SEATS_AVAILABLE:%s"
+SEATS_CACHE_TIMEOUT = 30    # seconds
+CONFERENCE_CACHE_TIMEOUT = 3600 # seconds versions & rendered forms are cached
+SEAT_SHARD_THRESHOLD = 1000 # conferences this big get sharded seats
+SEAT_SHARD_COUNT = 20       # keeps registration xg transactions under 25 groups
+SEAT_SYNC_INTERVAL = 10     # seconds between Conference.seatsAvailable syncs
+SEAT_ADJUSTMENTS_LIMIT = 20 # maxAttendees changes each SeatShard remembers
+MEMCACHE_IDEMPOTENCY_TPL = "IDEMPOTENCY:%s:%s"
+IDEMPOTENCY_TIMEOUT = 86400 # seconds replays are served from memcache
+IDEMPOTENCY_RETENTION_DAYS = 7 # days IdempotencyRecords are kept
+IDEMPOTENCY_KEY_MAX_LENGTH = 128 # keeps record key names within datastore limits
+IDEMPOTENCY_EXPIRE_BATCH_SIZE = 500
+CLAIM_QUEUE = 'registration-claims'   # pull queue, see queue.yaml
+CLAIM_BATCH_SIZE = 100      # claims applied per seat transaction
+CLAIM_LEASE_SECONDS = 60
+CLAIM_DRAIN_INTERVAL = 1    # seconds claims gather before a drain
+MEMCACHE_SEAT_HOLD_TPL = "SEAT_HOLD:%s:%s"         # user's hold: (bucket, expires)
+MEMCACHE_SEAT_HOLDS_TPL = "SEAT_HOLDS:%s"           # live holds per conference
+MEMCACHE_SEAT_HOLD_BUCKET_TPL = "SEAT_HOLDS:%s:%d"  # holds made per bucket
+MEMCACHE_SEAT_HOLD_CONFERENCES_KEY = "SEAT_HOLD_CONFERENCES" # {wsck: last bucket}
+SEAT_HOLD_SECONDS = 600
+SEAT_HOLD_BUCKET_SECONDS = 60
+SEAT_HOLD_LOOKBACK = 10     # expired buckets a release_seat_holds run revisits
+# hold counters outlive a missed release_seat_holds run, never a lost one
+SEAT_HOLD_COUNTER_TIMEOUT = SEAT_HOLD_SECONDS + (SEAT_HOLD_LOOKBACK + 2) * SEAT_HOLD_BUCKET_SECONDS
+BULK_REGISTRATION_CHUNK = 500 # attendees per seat transaction & batch put
+WAITLIST_BATCH_SIZE = 50    # waitlist entries promoted per seat transaction
+WAITLIST_PROMOTE_INTERVAL = 5 # seconds unregistrations gather before promotion
+QUERY_CACHE_TIMEOUT = 600   # seconds
+FILTER_ENGINE_RECHECK = 30  # seconds a filterEngine answer may lag a write
+# filterEngine pages may miss a write its last refresh didn't see yet
+PAGE_CACHE_TIMEOUT = FILTER_ENGINE_RECHECK if USE_FILTER_ENGINE else QUERY_CACHE_TIMEOUT
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+MAX_IN_SUBQUERIES = 30
+QUERY_PLAN_CACHE_SIZE = 256
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 DEFAULTS = {
@@ -64,21 +148,83 @@ OPERATORS = {
             'GTEQ': '>=',
             'LT':   '<',
             'LTEQ': '<=',
-            'NE':   '!='
+            'NE':   '!=',
+            'IN':   'IN'
             }
 
+# ndb runs these as several merged queries, which can't return cursors
+# without a __key__ sort order; they are paged by offset instead
+OFFSET_PAGED_OPERATORS = ('IN', 'NE')
+
+# formatted inequality operators, as tests of a value against the bound
+INEQUALITY_TESTS = {'<': operator.lt, '<=': operator.le, '>': operator.gt,
+                    '>=': operator.ge, '!=': operator.ne}
+
+FACET_FIELDS = ['city', 'topics', 'month']
+FACET_APPLIED_LIMIT = 200   # changes each ConferenceFacet remembers
+FACET_COUNT_BATCH = 500
+
+SUMMARY_FIELDS = ['name', 'city', 'startDate', 'endDate', 'maxAttendees', 'seatsAvailable']
+
+# indexed, single-valued Conference properties a projection query can return
+PROJECTABLE_FIELDS = ['name', 'description', 'organizerUserId', 'city', 'startDate',
+                      'month', 'endDate', 'maxAttendees', 'seatsAvailable']
+
 FIELDS =    {
             'CITY': 'city',
             'TOPIC': 'topics',
             'MONTH': 'month',
             'MAX_ATTENDEES': 'maxAttendees',
+            'SEATS_AVAILABLE': 'seatsAvailable',
             }
 
+filterEngine = ConferenceFilterEngine(FIELDS.values(), recheck=FILTER_ENGINE_RECHECK)
+
+conferenceConverter = converterFor(Conference, ConferenceForm)
+summaryConverter = converterFor(Conference, ConferenceSummaryForm)
+profileConverter = converterFor(Profile, ProfileForm)
+
+# filter signature -> query plan (or BadRequest message); per instance
+queryPlans = {}
+
+# websafeConferenceKey -> hold bucket last registered by this instance
+holdConferences = {}
+
+
+def organizerGroup(wsck):
+    """Return organizer user id, naming the entity group of a conference."""
+    return keyFromUrlsafe(wsck).root().id()
+
+
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_LIST_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    fields=messages.StringField(1, repeated=True),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
+)
+
+CONF_MUTATE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    idempotencyKey=messages.StringField(2),
+)
+
+CONF_BULK_REGISTER_REQUEST = endpoints.ResourceContainer(
+    BulkRegistrationForm,
+    websafeConferenceKey=messages.StringField(1),
+)
+
+CONF_CONDITIONAL_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2),
+)
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
     websafeConferenceKey=messages.StringField(1),
@@ -97,22 +243,40 @@ class ConferenceApi(remote.Service):
 
     def _copyConferenceToForm(self, conf, displayName):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
+        cf = conferenceConverter.convert(conf)
         if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
+            cf.organizerDisplayName = displayName
+        cf.etag = self._conferenceEtag(conf.version)
         return cf
 
 
+    @staticmethod
+    def _conferenceEtag(version):
+        """Return ETag for a Conference version stamp."""
+        return '"%d"' % (version or 0)
+
+
+    @staticmethod
+    def _putConference(conf):
+        """Put Conference with its version stamp bumped; once the write
+        commits, the memcache copy of the version is updated and the
+        cached ConferenceForm dropped."""
+        conf.version = (conf.version or 0) + 1
+        conf.put()
+        ndb.get_context().call_on_commit(
+            lambda: ConferenceApi._publishConferenceVersions([conf]))
+
+
+    @staticmethod
+    def _publishConferenceVersions(confs):
+        """Update memcache version copies & drop cached forms of confs."""
+        wscks = [urlsafeFromKey(conf.key) for conf in confs]
+        memcache.set_multi(dict((MEMCACHE_CONFERENCE_VERSION_TPL % wsck, conf.version)
+                                for wsck, conf in zip(wscks, confs)),
+                           time=CONFERENCE_CACHE_TIMEOUT)
+        memcache.delete_multi([MEMCACHE_CONFERENCE_FORM_TPL % wsck for wsck in wscks])
+
+
     def _createConferenceObject(self, request):
         """Create or update Conference object, returning ConferenceForm/request."""
         # preload necessary data items
@@ -127,7 +291,8 @@ class ConferenceApi(remote.Service):
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
         del data['websafeKey']
-        del data['organizerDisplayName']
+        del data['etag']
+        del data['notModified']
 
         # add default values for those missing (both data model & outbound Message)
         for df in DEFAULTS:
@@ -149,15 +314,29 @@ class ConferenceApi(remote.Service):
             data["seatsAvailable"] = data["maxAttendees"]
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
-        p_key = ndb.Key(Profile, user_id)
+        prof = self._getProfileFromUser()
+        p_key = prof.key
         c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
         c_key = ndb.Key(Conference, c_id, parent=p_key)
         data['key'] = c_key
+        # big conferences keep their seats in SeatShards, outside the
+        # organizer's entity group; create them before the Conference
+        if data["maxAttendees"] >= SEAT_SHARD_THRESHOLD:
+            data['seatShards'] = SEAT_SHARD_COUNT
+            per_shard, extra = divmod(data["seatsAvailable"], SEAT_SHARD_COUNT)
+            ndb.put_multi([SeatShard(key=key, seatsAvailable=per_shard + (i < extra))
+                           for i, key in enumerate(self._seatShardKeys(c_key, SEAT_SHARD_COUNT))])
         data['organizerUserId'] = request.organizerUserId = user_id
+        # store organizer's displayName so list reads need no Profile get
+        data['organizerDisplayName'] = request.organizerDisplayName = prof.displayName
 
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
+        conf = Conference(**data)
+        self._putConference(conf)
+        request.etag = self._conferenceEtag(conf.version)
+        self._bumpConferencesGeneration()
+        self._queueFacetUpdate(None, conf)
         taskqueue.add(params={'email': user.email(),
             'conferenceInfo': repr(request)},
             url='/tasks/send_confirmation_email'
@@ -165,7 +344,8 @@ class ConferenceApi(remote.Service):
         return request
 
 
-    @ndb.transactional()
+    @txstats.transactional('updateConference',
+                           lambda self, request: organizerGroup(request.websafeConferenceKey))
     def _updateConferenceObject(self, request):
         user = endpoints.get_current_user()
         if not user:
@@ -176,7 +356,7 @@ class ConferenceApi(remote.Service):
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
 
         # update existing conference
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = keyFromUrlsafe(request.websafeConferenceKey).get()
         # check that conference exists
         if not conf:
             raise endpoints.NotFoundException(
@@ -189,7 +369,14 @@ class ConferenceApi(remote.Service):
 
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
+        oldFacets = self._facetValues(conf)
+        oldMaxAttendees = conf.maxAttendees
+        oldSeatsAvailable = conf.seatsAvailable
         for field in request.all_fields():
+            if field.name in ('organizerDisplayName', 'etag', 'notModified'):
+                continue    # kept in sync by saveProfile() / every write
+            if field.name == 'seatsAvailable' and conf.seatShards:
+                continue    # kept in SeatShards; see maxAttendees below
             data = getattr(request, field.name)
             # only copy fields where we get data
             if data not in (None, []):
@@ -200,9 +387,20 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
-        conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        self._putConference(conf)
+        ndb.get_context().call_on_commit(self._bumpConferencesGeneration)
+        if not conf.seatShards and conf.seatsAvailable != oldSeatsAvailable:
+            ndb.get_context().call_on_commit(
+                lambda: memcache.delete(MEMCACHE_SEATS_TPL % request.websafeConferenceKey))
+        self._queueFacetUpdate(oldFacets, conf)
+        if conf.seatShards and conf.maxAttendees != oldMaxAttendees:
+            taskqueue.add(params={'websafeConferenceKey': request.websafeConferenceKey,
+                'delta': (conf.maxAttendees or 0) - (oldMaxAttendees or 0),
+                'version': conf.version},
+                url='/tasks/adjust_seat_shards',
+                transactional=True
+            )
+        return self._copyConferenceToForm(conf, None)
 
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
@@ -220,19 +418,59 @@ class ConferenceApi(remote.Service):
         return self._updateConferenceObject(request)
 
 
-    @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
+    @endpoints.method(CONF_CONDITIONAL_GET_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='GET', name='getConference')
     def getConference(self, request):
-        """Return requested conference (by websafeConferenceKey)."""
+        """Return requested conference (by websafeConferenceKey); if it
+        still matches the ETag given in ifNoneMatch/If-None-Match, only
+        its websafeKey & etag with notModified set. Endpoints can't send
+        a 304, so the unchanged state is reported in the body."""
+        wsck = request.websafeConferenceKey
+        etags = self._ifNoneMatch(request)
+
+        # version & rendered form come back in one memcache round trip;
+        # a form is only good for the version it was rendered from
+        version_key = MEMCACHE_CONFERENCE_VERSION_TPL % wsck
+        form_key = MEMCACHE_CONFERENCE_FORM_TPL % wsck
+        cached = memcache.get_multi([version_key, form_key])
+        version = cached.get(version_key)
+        if version is not None:
+            if self._conferenceEtag(version) in etags:
+                return self._notModifiedForm(wsck, version)
+            if form_key in cached and cached[form_key][0] == version:
+                return protobuf.decode_message(ConferenceForm, cached[form_key][1])
+
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = keyFromUrlsafe(wsck).get()
         if not conf:
             raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+                'No conference found with key: %s' % wsck)
+        memcache.add(version_key, conf.version, time=CONFERENCE_CACHE_TIMEOUT)
+        if self._conferenceEtag(conf.version) in etags:
+            return self._notModifiedForm(wsck, conf.version)
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        cf = self._copyConferenceToForm(conf, None)
+        memcache.set(form_key, (conf.version, protobuf.encode_message(cf)),
+                     time=CONFERENCE_CACHE_TIMEOUT)
+        return cf
+
+
+    def _notModifiedForm(self, wsck, version):
+        """Return ConferenceForm telling the client its copy is current."""
+        return ConferenceForm(websafeKey=wsck, etag=self._conferenceEtag(version),
+                              notModified=True)
+
+
+    def _ifNoneMatch(self, request):
+        """Return set of ETags from ifNoneMatch parameter or header."""
+        value = request.ifNoneMatch
+        if not value:
+            headers = getattr(getattr(self, 'request_state', None), 'headers', None)
+            value = headers.get('If-None-Match') if headers else None
+        if not value:
+            return set()
+        return set('"%s"' % etag.strip().strip('"') for etag in value.split(','))
 
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
@@ -248,17 +486,112 @@ class ConferenceApi(remote.Service):
 
         # create ancestor query for all key matches for this user
         confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
+            items=conferenceConverter.convert_many(confs)
         )
 
 
-    def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
+    def _streamConferencesCreated(self, user_id, page_token=None):
+        """Return (iterator of ConferenceForm, next page token) for up to
+        STREAM_PAGE_SIZE conferences created by user, read in batches
+        without filling the context cache."""
+        confs, next_page_token = self._streamPage(
+            Conference.query(ancestor=ndb.Key(Profile, user_id)), page_token)
+        return (conferenceConverter.convert(conf) for conf in confs), next_page_token
+
+
+    def _streamQueryConferences(self, request):
+        """Return (iterator of ConferenceForm, next page token) for up to
+        STREAM_PAGE_SIZE conferences matching request filters, from
+        request.pageToken on; filters are checked before iteration starts."""
+        if USE_FILTER_ENGINE:
+            inequality_filter, filters = self._formatFilters(request.filters,
+                single_inequality=False)
+            filterEngine.refresh(memcache.get(MEMCACHE_CONFERENCES_GENERATION_KEY)
+                                 or self._initConferencesGeneration())
+            keys = filterEngine.query(filters)
+            # the engine's results are an ordered list; tokens are offsets
+            try:
+                offset = int(request.pageToken or 0)
+            except ValueError:
+                raise endpoints.BadRequestException("Invalid pageToken.")
+            if offset < 0:
+                raise endpoints.BadRequestException("Invalid pageToken.")
+            confs = self._iterKeys(keys[offset:offset + STREAM_PAGE_SIZE])
+            next_page_token = None
+            if len(keys) > offset + STREAM_PAGE_SIZE:
+                next_page_token = str(offset + STREAM_PAGE_SIZE)
+        elif self._offsetPaged(request):
+            raise endpoints.BadRequestException(
+                "IN and != filters can't be streamed; use queryConferences.")
+        else:
+            confs, next_page_token = self._streamPage(
+                self._getQuery(request), request.pageToken)
+        return (conferenceConverter.convert(conf) for conf in confs), next_page_token
+
+
+    @staticmethod
+    def _streamPage(q, page_token):
+        """Return (Conferences, next page token) for one STREAM_PAGE_SIZE
+        page of query q."""
+        try:
+            cursor = Cursor(urlsafe=page_token) if page_token else None
+        except datastore_errors.BadValueError:
+            raise endpoints.BadRequestException("Invalid pageToken.")
+        confs, next_cursor, more = q.fetch_page(STREAM_PAGE_SIZE, start_cursor=cursor,
+            batch_size=STREAM_BATCH_SIZE, use_cache=False)
+        return confs, (next_cursor.urlsafe() if more and next_cursor else None)
+
+
+    @staticmethod
+    def _iterKeys(keys):
+        """Yield entities for keys, getting them a batch at a time."""
+        for i in xrange(0, len(keys), STREAM_BATCH_SIZE):
+            for entity in ndb.get_multi(keys[i:i + STREAM_BATCH_SIZE], use_cache=False):
+                if entity:
+                    yield entity
+
+
+    def _getQuery(self, request, formatted=None):
+        """Return formatted query from the submitted filters; formatted is
+        their _formatFilters() result, if the caller already has it."""
+        plan = self._queryPlan(request.filters)
+        inequality_filter, filters = formatted or self._formatFilters(request.filters)
+        indexadvisor.recordShape(inequality_filter, filters)
+        if plan["query"] is None:
+            return self._buildQuery(inequality_filter, filters)
+        # only the values change between requests with the same plan
+        return plan["query"].bind(*[filtr["value"] for filtr in filters])
+
+
+    def _getQueries(self, inequality_filter, filters):
+        """Expand IN filters into one equality query per combination of values."""
+        indexadvisor.recordShape(inequality_filter, filters)
+        return [self._buildQuery(inequality_filter, combo)
+                for combo in self._filterCombos(filters)]
+
+
+    @staticmethod
+    def _filterCombos(filters):
+        """Return lists of filters, one per combination of IN values, with
+        each IN filter replaced by an equality filter on one value."""
+        combos = [[]]
+        for filtr in filters:
+            if filtr["operator"] == "IN":
+                combos = [combo + [dict(filtr, operator="=", value=value)]
+                          for combo in combos for value in filtr["value"]]
+            else:
+                combos = [combo + [filtr] for combo in combos]
+        if len(combos) > MAX_IN_SUBQUERIES:
+            raise endpoints.BadRequestException(
+                "IN filters may expand to at most %d queries." % MAX_IN_SUBQUERIES)
+        return combos
+
+
+    def _buildQuery(self, inequality_filter, filters):
+        """Return query for filters as formatted by _formatFilters()."""
         q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
 
         # If exists, sort on inequality filter first
         if not inequality_filter:
@@ -268,39 +601,98 @@ class ConferenceApi(remote.Service):
             q = q.order(Conference.name)
 
         for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
             formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
             q = q.filter(formatted_query)
         return q
 
 
-    def _formatFilters(self, filters):
-        """Parse, check validity and format user supplied filters."""
-        formatted_filters = []
+    def _queryPlan(self, filters, single_inequality=True):
+        """Return cached plan for the field/operator shape of filters;
+        invalid shapes are cached too, and fail without re-parsing."""
+        signature = (single_inequality,) + tuple((f.field, f.operator) for f in filters)
+        plan = queryPlans.get(signature)
+        if plan is None:
+            try:
+                plan = self._compileQueryPlan(filters, single_inequality)
+            except endpoints.BadRequestException as e:
+                plan = str(e)
+            if len(queryPlans) >= QUERY_PLAN_CACHE_SIZE:
+                queryPlans.clear()
+            queryPlans[signature] = plan
+        if isinstance(plan, basestring):
+            raise endpoints.BadRequestException(plan)
+        return plan
+
+
+    def _compileQueryPlan(self, filters, single_inequality):
+        """Check validity of filter fields & operators and return plan:
+        mapped (field, operator) steps, the inequality field and, when
+        one query serves it, an ordered query with value parameters."""
+        steps = []
         inequality_field = None
 
         for f in filters:
-            filtr = {field.name: getattr(f, field.name) for field in f.all_fields()}
-
             try:
-                filtr["field"] = FIELDS[filtr["field"]]
-                filtr["operator"] = OPERATORS[filtr["operator"]]
+                field = FIELDS[f.field]
+                operator = OPERATORS[f.operator]
             except KeyError:
                 raise endpoints.BadRequestException("Filter contains invalid field or operator.")
 
-            # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
+            # Every operation except "=" and "IN" is an inequality
+            if operator not in ("=", "IN") and single_inequality:
                 # check if inequality operation has been used in previous filters
                 # disallow the filter if inequality was performed on a different field before
                 # track the field on which the inequality operation is performed
-                if inequality_field and inequality_field != filtr["field"]:
+                if inequality_field and inequality_field != field:
                     raise endpoints.BadRequestException("Inequality filter is allowed on only one field.")
                 else:
-                    inequality_field = filtr["field"]
+                    inequality_field = field
+
+            steps.append((field, operator))
+
+        # IN filters fan out to several queries (see _getQueries())
+        query = None
+        if single_inequality and all(operator != "IN" for field, operator in steps):
+            query = Conference.query()
+            # If exists, sort on inequality filter first
+            if inequality_field:
+                query = query.order(ndb.GenericProperty(inequality_field))
+            query = query.order(Conference.name)
+            for i, (field, operator) in enumerate(steps):
+                query = query.filter(ndb.query.ParameterNode(
+                    getattr(Conference, field), operator, ndb.query.Parameter(i + 1)))
+        return {"steps": steps, "inequality": inequality_field, "query": query}
+
+
+    def _formatFilters(self, filters, single_inequality=True):
+        """Parse, check validity and format user supplied filters."""
+        plan = self._queryPlan(filters, single_inequality)
+        formatted_filters = []
+
+        for (field, operator), f in zip(plan["steps"], filters):
+            filtr = {"field": field, "operator": operator, "value": f.value}
+
+            # IN takes its values from the repeated values field
+            if operator == "IN":
+                if not f.values:
+                    raise endpoints.BadRequestException(
+                        "IN filter requires at least one value.")
+                filtr["value"] = f.values
+
+            if field in ["month", "maxAttendees", "seatsAvailable"]:
+                try:
+                    if operator == "IN":
+                        filtr["value"] = [int(v) for v in filtr["value"]]
+                    else:
+                        filtr["value"] = int(filtr["value"])
+                except (TypeError, ValueError):
+                    raise endpoints.BadRequestException(
+                        "Filter on %s requires an integer value." % field)
+            if operator == "IN":
+                filtr["value"] = sorted(set(filtr["value"]))
 
             formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+        return (plan["inequality"], formatted_filters)
 
 
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
@@ -308,41 +700,471 @@ class ConferenceApi(remote.Service):
             http_method='POST',
             name='queryConferences')
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
+        """Query for conferences, one page at a time."""
+        # filters are formatted once & passed to every step below
+        formatted = self._requestFilters(request)
+        # cached pages are tagged with the generation they were built in;
+        # fetch both in one memcache round trip
+        cache_key = self._queryCacheKey(request, formatted)
+        cached = memcache.get_multi([MEMCACHE_CONFERENCES_GENERATION_KEY, cache_key])
+        generation = cached.get(MEMCACHE_CONFERENCES_GENERATION_KEY)
+        if generation is None:
+            generation = self._initConferencesGeneration()
+        elif cache_key in cached and cached[cache_key][0] == generation:
+            return protobuf.decode_message(ConferenceForms, cached[cache_key][1])
+
+        fields = self._fieldMask(request.fields)
+        known = {}
+        if fields and set(fields) <= set(PROJECTABLE_FIELDS + ['websafeKey']):
+            conferences, next_page_token, known = self._getProjectedPage(
+                request, generation, fields, formatted)
+        elif USE_FILTER_ENGINE:
+            conferences, next_page_token = self._engineFetchPage(
+                request, generation, formatted)
+        elif self._offsetPaged(request):
+            conferences, next_page_token = self._fanOutFetchPage(request, formatted)
+        else:
+            conferences, next_cursor, more = self._fetchPage(
+                self._getQuery(request, formatted), request.pageSize, request.pageToken)
+            next_page_token = next_cursor.urlsafe() if more and next_cursor else None
+
+        # return individual ConferenceForm object per Conference;
+        # organizerDisplayName is stored on the Conference itself
+        forms = ConferenceForms(
+                items=converterFor(Conference, ConferenceForm, fields).convert_many(
+                    conferences, **known),
+                nextPageToken=next_page_token
+        )
+        memcache.set(cache_key, (generation, protobuf.encode_message(forms)),
+            time=PAGE_CACHE_TIMEOUT)
+        return forms
 
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
 
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+    def _requestFilters(self, request):
+        """Return _formatFilters() result for request's filters, checked as
+        the configured query path (datastore or filterEngine) needs."""
+        return self._formatFilters(request.filters,
+            single_inequality=not USE_FILTER_ENGINE)
 
-        # return individual ConferenceForm object per Conference
-        return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
-                conferences]
+
+    def _queryCacheKey(self, request, formatted, key_tpl=MEMCACHE_QUERY_KEY_TPL):
+        """Return memcache key for the normalized filters & page of request."""
+        inequality_filter, filters = formatted
+        normalized = sorted((f["field"], f["operator"], f["value"]) for f in filters)
+        return key_tpl % hashlib.md5(repr(
+            (normalized, request.pageSize, request.pageToken,
+             sorted(request.fields)))).hexdigest()
+
+
+    def _fieldMask(self, fields):
+        """Return checked list of ConferenceForm fields to fill, or None
+        for all of them."""
+        if not fields:
+            return None
+        for field in fields:
+            try:
+                ConferenceForm.field_by_name(field)
+            except KeyError:
+                raise endpoints.BadRequestException(
+                    "Unknown field in fields: %s" % field)
+        return sorted(set(fields))
+
+
+    @staticmethod
+    def _initConferencesGeneration():
+        """Start the generation counter at a value no old cache entry can
+        carry (it may have been evicted); return current generation."""
+        memcache.add(MEMCACHE_CONFERENCES_GENERATION_KEY, int(time.time() * 1000))
+        return memcache.get(MEMCACHE_CONFERENCES_GENERATION_KEY)
+
+
+    @staticmethod
+    def _bumpConferencesGeneration():
+        """Invalidate all cached queryConferences() results."""
+        if memcache.incr(MEMCACHE_CONFERENCES_GENERATION_KEY) is None:
+            ConferenceApi._initConferencesGeneration()
+
+
+    def _fetchPage(self, q, page_size, page_token, **options):
+        """Run query once, returning (results, next cursor, more) for one page."""
+        page_size = page_size or DEFAULT_PAGE_SIZE
+        if page_size < 1 or page_size > MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                "pageSize must be between 1 and %d." % MAX_PAGE_SIZE)
+        try:
+            cursor = Cursor(urlsafe=page_token) if page_token else None
+        except datastore_errors.BadValueError:
+            raise endpoints.BadRequestException("Invalid pageToken.")
+        return q.fetch_page(page_size, start_cursor=cursor, **options)
+
+
+    @staticmethod
+    def _offsetPaged(request):
+        """Return True if request's filters need offset paging."""
+        return any(f.operator in OFFSET_PAGED_OPERATORS for f in request.filters)
+
+
+    def _offsetPage(self, request):
+        """Return (page size, offset) for queries paged by offset tokens."""
+        page_size = request.pageSize or DEFAULT_PAGE_SIZE
+        if page_size < 1 or page_size > MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                "pageSize must be between 1 and %d." % MAX_PAGE_SIZE)
+        try:
+            offset = int(request.pageToken or 0)
+        except ValueError:
+            raise endpoints.BadRequestException("Invalid pageToken.")
+        if offset < 0:
+            raise endpoints.BadRequestException("Invalid pageToken.")
+        return page_size, offset
+
+
+    def _fanOutFetchPage(self, request, formatted):
+        """Run one sub-query per IN value concurrently and merge them,
+        returning (results, next page token); page tokens are offsets.
+        Also serves != filters, whose queries can't be cursor paged."""
+        page_size, offset = self._offsetPage(request)
+        inequality_filter, filters = formatted
+        indexadvisor.recordShape(inequality_filter, filters)
+        combos = self._filterCombos(filters)
+        queries = [self._buildQuery(inequality_filter, combo) for combo in combos]
+
+        # an entity sorts by the smallest of its inequality field's values
+        # that pass the inequality filters; a sub-query that also pins the
+        # field with = (IN) can't project it, but the value is known
+        inequalities = [(INEQUALITY_TESTS[f["operator"]], f["value"]) for f in filters
+                        if f["field"] == inequality_filter and f["operator"] in INEQUALITY_TESTS]
+        def sortValue(conf, combo):
+            pinned = [f["value"] for f in combo
+                      if f["field"] == inequality_filter and f["operator"] == "="]
+            if pinned:
+                return pinned[0]
+            values = getattr(conf, inequality_filter)
+            values = [v for v in (values if isinstance(values, list) else [values])
+                      if all(test(v, bound) for test, bound in inequalities)]
+            return min(values) if values else None
+
+        # sub-queries read only their sort properties, which the index
+        # serving their order already holds, and each only needs its own
+        # first offset + page_size + 1 conferences; start all before waiting
+        limit = offset + page_size + 1
+        futures = []
+        for combo, q in zip(combos, queries):
+            projection = ['name']
+            if inequality_filter and not any(f["field"] == inequality_filter and
+                                             f["operator"] == "=" for f in combo):
+                projection.insert(0, inequality_filter)
+            futures.append(self._distinctRows(q, limit, projection))
+        try:
+            results = [future.get_result() for future in futures]
+        except datastore_errors.NeedIndexError:
+            # no projection index for this filter shape; read entities
+            results = [q.fetch(limit) for q in queries]
+
+        # merge & de-duplicate in the order the single query would use
+        merged = {}
+        for combo, result in zip(combos, results):
+            for conf in result:
+                if not inequality_filter:
+                    sort_key = (conf.name, conf.key)
+                else:
+                    sort_key = (sortValue(conf, combo), conf.name, conf.key)
+                merged[conf.key] = min(merged.get(conf.key, sort_key), sort_key)
+        keys = [sort_key[-1] for sort_key in sorted(merged.values())]
+
+        # only the page itself is read in full
+        page_keys = keys[offset:offset + page_size]
+        conferences = [conf for conf in ndb.get_multi(page_keys) if conf]
+        if len(keys) > offset + page_size:
+            return conferences, str(offset + page_size)
+        return conferences, None
+
+
+    @staticmethod
+    @ndb.tasklet
+    def _distinctRows(q, limit, projection):
+        """Return rows of projection query q for its first limit distinct
+        entities; a repeated property projects one row per value, so
+        limit can't be passed to the datastore."""
+        rows = []
+        seen = set()
+        it = q.iter(projection=projection, batch_size=limit)
+        while len(seen) < limit and (yield it.has_next_async()):
+            row = it.next()
+            rows.append(row)
+            seen.add(row.key)
+        raise ndb.Return(rows)
+
+
+    def _engineFetchPage(self, request, generation, formatted):
+        """Answer query from filterEngine, returning (results, next page token);
+        page tokens are offsets into the name-ordered matches."""
+        page_size, offset = self._offsetPage(request)
+
+        inequality_filter, filters = formatted
+        # the page reflects generation, give or take writes the refresh
+        # missed; callers cache it only for PAGE_CACHE_TIMEOUT
+        filterEngine.refresh(generation)
+        keys = filterEngine.query(filters)
+        # entities deleted since the last refresh come back as None
+        conferences = [conf for conf in ndb.get_multi(keys[offset:offset + page_size])
+                       if conf]
+        if offset + page_size < len(keys):
+            return conferences, str(offset + page_size)
+        return conferences, None
+
+
+    def _getProjectedPage(self, request, generation, fields, formatted):
+        """Return (conferences, next page token, known field values) for
+        one page holding fields; a projection (or keys-only) query when an
+        index can serve it."""
+        if USE_FILTER_ENGINE:
+            conferences, next_page_token = self._engineFetchPage(
+                request, generation, formatted)
+            return conferences, next_page_token, {}
+        if self._offsetPaged(request):
+            conferences, next_page_token = self._fanOutFetchPage(request, formatted)
+            return conferences, next_page_token, {}
+
+        # properties in equality filters can't be projected, but their
+        # value is already known
+        inequality_filter, filters = formatted
+        known = dict((f["field"], f["value"]) for f in filters
+                     if f["operator"] == "=" and f["field"] in fields)
+        projection = [p for p in fields if p in PROJECTABLE_FIELDS and p not in known]
+        q = self._getQuery(request, formatted)
+        try:
+            if projection:
+                conferences, next_cursor, more = self._fetchPage(
+                    q, request.pageSize, request.pageToken, projection=projection)
+            else:
+                # nothing left to read but the key
+                keys, next_cursor, more = self._fetchPage(
+                    q, request.pageSize, request.pageToken, keys_only=True)
+                conferences = [Conference(key=key) for key in keys]
+        except datastore_errors.NeedIndexError:
+            # no projection index for this filter shape; read entities
+            known = {}
+            conferences, next_cursor, more = self._fetchPage(
+                q, request.pageSize, request.pageToken)
+        return conferences, next_cursor.urlsafe() if more and next_cursor else None, known
+
+
+    @endpoints.method(ConferenceQueryForms, ConferenceSummaryForms,
+            path='queryConferencesSummary',
+            http_method='POST',
+            name='queryConferencesSummary')
+    def queryConferencesSummary(self, request):
+        """Query for conferences, returning list-view fields only."""
+        formatted = self._requestFilters(request)
+        cache_key = self._queryCacheKey(request, formatted, MEMCACHE_SUMMARY_KEY_TPL)
+        cached = memcache.get_multi([MEMCACHE_CONFERENCES_GENERATION_KEY, cache_key])
+        generation = cached.get(MEMCACHE_CONFERENCES_GENERATION_KEY)
+        if generation is None:
+            generation = self._initConferencesGeneration()
+        elif cache_key in cached and cached[cache_key][0] == generation:
+            return protobuf.decode_message(ConferenceSummaryForms, cached[cache_key][1])
+
+        conferences, next_page_token, known = self._getProjectedPage(
+            request, generation, SUMMARY_FIELDS, formatted)
+        forms = ConferenceSummaryForms(
+                items=summaryConverter.convert_many(conferences, **known),
+                nextPageToken=next_page_token
         )
+        memcache.set(cache_key, (generation, protobuf.encode_message(forms)),
+            time=PAGE_CACHE_TIMEOUT)
+        return forms
+
+
+# - - - Facets - - - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _facetValues(conf):
+        """Return set of (field, value) facet pairs for a Conference."""
+        pairs = set()
+        for field in FACET_FIELDS:
+            value = getattr(conf, field)
+            for v in (value if isinstance(value, list) else [value]):
+                if v is not None:
+                    pairs.add((field, unicode(v)))
+        return pairs
+
+
+    def _queueFacetUpdate(self, oldFacets, conf):
+        """Enqueue facet count changes for a created/updated Conference;
+        transactional, so it only runs if the write commits."""
+        newFacets = self._facetValues(conf)
+        oldFacets = oldFacets or set()
+        deltas = [(f, v, 1) for f, v in newFacets - oldFacets] + \
+                 [(f, v, -1) for f, v in oldFacets - newFacets]
+        if deltas:
+            # conf was just put, so its version names this change
+            taskqueue.add(params={'deltas': json.dumps(deltas),
+                'change': '%s:%d' % (urlsafeFromKey(conf.key), conf.version)},
+                url='/tasks/update_facet_counts',
+                transactional=ndb.in_transaction()
+            )
+
+
+    @staticmethod
+    def _updateFacetCounts(deltas, change):
+        """Apply [field, value, delta] changes to ConferenceFacet counts;
+        used by the update_facet_counts task. Each facet remembers the
+        changes it has applied, so a retried task does not count twice."""
+        @ndb.transactional()
+        def adjust(field, value, delta):
+            key = ndb.Key(ConferenceFacet, '%s:%s' % (field, value))
+            facet = key.get() or ConferenceFacet(key=key, field=field, value=value)
+            if change in facet.applied:
+                return
+            facet.count = max(0, facet.count + delta)
+            facet.applied = (facet.applied + [change])[-FACET_APPLIED_LIMIT:]
+            facet.put()
+        for field, value, delta in json.loads(deltas):
+            adjust(field, value, delta)
+
+
+    @staticmethod
+    def _recountFacets():
+        """Set every ConferenceFacet count from scratch, seeding them for
+        Conferences created before facets were kept; used by the
+        recount_facets task. One projection query per facet field, on its
+        built-in index. Changes queued while it runs may be applied on top
+        of the recount, so run it before opening facet reads."""
+        counts = {}
+        # projection on a repeated property yields one row per value
+        for field in FACET_FIELDS:
+            for conf in Conference.query().iter(projection=[getattr(Conference, field)],
+                                                batch_size=1000):
+                pair = (field, unicode(getattr(conf, field)))
+                counts[pair] = counts.get(pair, 0) + 1
+        facets = dict(((facet.field, facet.value), facet)
+                      for facet in ConferenceFacet.query())
+        for (field, value), count in counts.iteritems():
+            facet = facets.get((field, value))
+            if facet is None:
+                facets[(field, value)] = ConferenceFacet(
+                    id='%s:%s' % (field, value), field=field, value=value)
+        for pair, facet in facets.iteritems():
+            facet.count = counts.get(pair, 0)
+        ndb.put_multi(facets.values())
+
+
+    def _countFacets(self, request, generation, formatted):
+        """Return {field: {value: count}} over Conferences matching request."""
+        inequality_filter, filters = formatted
+        if USE_FILTER_ENGINE:
+            filterEngine.refresh(generation)
+            return filterEngine.facets(filters, FACET_FIELDS)
+
+        counts = dict((field, {}) for field in FACET_FIELDS)
+        if not request.filters:
+            # unfiltered counts are kept up to date by update_facet_counts
+            for facet in ConferenceFacet.query(ConferenceFacet.count > 0):
+                counts[facet.field][facet.value] = facet.count
+            return counts
+
+        # counts come from indexes only: the matching set, keys only, and a
+        # projection per facet field; IN & != run one query per value, so
+        # a Conference can come back more than once. No order is needed,
+        # which keeps the indexes these queries need to a minimum.
+        indexadvisor.recordShape(inequality_filter, filters)
+        combos = self._filterCombos(filters)
+        keyFutures = [self._unorderedQuery(combo).fetch_async(
+                      keys_only=True, batch_size=FACET_COUNT_BATCH) for combo in combos]
+
+        projFutures = []
+        pinned = {}
+        for field in FACET_FIELDS:
+            ops = set(f["operator"] for f in filters if f["field"] == field)
+            if not ops:
+                # nothing filters the field, so every value is projected
+                combos_for = [(combo, False) for combo in combos]
+            elif getattr(Conference, field)._repeated:
+                # filtered values of a repeated field would hide its other
+                # values; project it through the other filters & keep rows
+                # of matching Conferences
+                others = [f for f in filters if f["field"] != field]
+                combos_for = [(combo, True) for combo in self._filterCombos(others)]
+            elif ops & set(["=", "IN"]):
+                # equality filters can't be projected; the value is the
+                # one each combination pins
+                pinned[field] = True
+                continue
+            else:
+                combos_for = [(combo, False) for combo in combos]
+            projFutures.extend((field, keep, self._unorderedQuery(combo).fetch_async(
+                projection=[field], batch_size=FACET_COUNT_BATCH))
+                for combo, keep in combos_for)
+
+        matchesByCombo = [set(future.get_result()) for future in keyFutures]
+        matches = set().union(*matchesByCombo)
+        try:
+            rows = set()
+            for field, keep, future in projFutures:
+                for conf in future.get_result():
+                    if not keep or conf.key in matches:
+                        rows.add((field, unicode(getattr(conf, field)), conf.key))
+        except datastore_errors.NeedIndexError:
+            # no projection index for this filter shape; read entities
+            for conf in ndb.get_multi(list(matches)):
+                if conf:
+                    for field, value in self._facetValues(conf):
+                        counts[field][value] = counts[field].get(value, 0) + 1
+            return counts
+
+        for field in pinned:
+            for combo, keys in zip(combos, matchesByCombo):
+                value = [f["value"] for f in combo if f["field"] == field][0]
+                rows.update((field, unicode(value), key) for key in keys)
+        for field, value, key in rows:
+            counts[field][value] = counts[field].get(value, 0) + 1
+        return counts
+
+
+    @staticmethod
+    def _unorderedQuery(filters):
+        """Return Conference query for filters, without a sort order."""
+        return Conference.query(*[ndb.query.FilterNode(f["field"], f["operator"], f["value"])
+                                  for f in filters])
+
+
+    @endpoints.method(ConferenceQueryForms, FacetForms,
+            path='facetConferences',
+            http_method='POST',
+            name='facetConferences')
+    def facetConferences(self, request):
+        """Count conferences matching filters per city, topic & month."""
+        # cached like queryConferences() results, under the same generation
+        formatted = self._requestFilters(request)
+        cache_key = self._queryCacheKey(request, formatted, MEMCACHE_FACETS_KEY_TPL)
+        cached = memcache.get_multi([MEMCACHE_CONFERENCES_GENERATION_KEY, cache_key])
+        generation = cached.get(MEMCACHE_CONFERENCES_GENERATION_KEY)
+        if generation is None:
+            generation = self._initConferencesGeneration()
+        elif cache_key in cached and cached[cache_key][0] == generation:
+            return protobuf.decode_message(FacetForms, cached[cache_key][1])
+
+        counts = self._countFacets(request, generation, formatted)
+        forms = FacetForms(facets=[FacetForm(field=field,
+            values=[FacetValueForm(value=unicode(value), count=count)
+                    for value, count in sorted(counts[field].items(),
+                        key=lambda item: (-item[1], unicode(item[0])))
+                    if count > 0])
+            for field in FACET_FIELDS])
+        memcache.set(cache_key, (generation, protobuf.encode_message(forms)),
+            time=PAGE_CACHE_TIMEOUT)
+        return forms
 
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
+        form = profileConverter.convert(prof)
+        form.conferenceKeysToAttend = [r_key.id() for r_key in
+            Registration.query(ancestor=prof.key).iter(keys_only=True)]
+        return form
 
 
     def _getProfileFromUser(self):
@@ -365,10 +1187,46 @@ class ConferenceApi(remote.Service):
                 teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
             )
             profile.put()
+        elif profile.conferenceKeysToAttend:
+            profile = self._migrateRegistrations(p_key)
 
         return profile      # return Profile
 
 
+    @staticmethod
+    @ndb.transactional()
+    def _migrateRegistrations(p_key):
+        """Move Profile's legacy conferenceKeysToAttend list into
+        Registration entities, returning the updated Profile."""
+        profile = p_key.get()
+        ndb.put_multi([Registration(key=ConferenceApi._registrationKey(p_key, wsck),
+                                    conferenceKey=keyFromUrlsafe(wsck))
+                       for wsck in profile.conferenceKeysToAttend])
+        profile.conferenceKeysToAttend = []
+        profile.put()
+        return profile
+
+
+    @staticmethod
+    def _backfillRegistrations(websafeCursor=None):
+        """Migrate a batch of Profiles still holding a legacy
+        conferenceKeysToAttend list; used by the backfill_registrations
+        task, which re-enqueues itself until every Profile is done. Seat
+        checks read other users' Registrations, so they can't wait for
+        each user's own next request."""
+        cursor = Cursor(urlsafe=websafeCursor) if websafeCursor else None
+        profiles, next_cursor, more = Profile.query().fetch_page(
+            REGISTRATION_BACKFILL_BATCH_SIZE, start_cursor=cursor)
+        for profile in profiles:
+            if profile.conferenceKeysToAttend:
+                ConferenceApi._migrateRegistrations(profile.key)
+
+        if more and next_cursor:
+            taskqueue.add(params={'websafeCursor': next_cursor.urlsafe()},
+                url='/tasks/backfill_registrations'
+            )
+
+
     def _doProfile(self, save_request=None):
         """Get user Profile and return to user, possibly updating it first."""
         # get user Profile
@@ -376,6 +1234,7 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            oldDisplayName = prof.displayName
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
@@ -386,6 +1245,11 @@ class ConferenceApi(remote.Service):
                         #else:
                         #    setattr(prof, field, val)
                         prof.put()
+            # push new displayName out to the user's conferences
+            if prof.displayName != oldDisplayName:
+                taskqueue.add(params={'organizerUserId': prof.key.id()},
+                    url='/tasks/update_organizer_display_name'
+                )
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
@@ -405,6 +1269,70 @@ class ConferenceApi(remote.Service):
         return self._doProfile(request)
 
 
+    @staticmethod
+    def _updateOrganizerDisplayName(organizerUserId, websafeCursor=None):
+        """Copy organizer's current displayName to a batch of their
+        Conferences; used by the update_organizer_display_name task,
+        which re-enqueues itself until every conference is done.
+        """
+        prof = ndb.Key(Profile, organizerUserId).get()
+        if not prof:
+            return
+        cursor = Cursor(urlsafe=websafeCursor) if websafeCursor else None
+        confs, next_cursor, more = Conference.query(ancestor=prof.key).fetch_page(
+            ORGANIZER_NAME_BATCH_SIZE, start_cursor=cursor)
+
+        stale = [conf.key for conf in confs
+                 if conf.organizerDisplayName != prof.displayName]
+        changed = [ConferenceApi._setOrganizerDisplayName(c_key, prof.displayName)
+                   for c_key in stale]
+        if any(changed):
+            ConferenceApi._bumpConferencesGeneration()
+
+        if more and next_cursor:
+            taskqueue.add(params={'organizerUserId': organizerUserId,
+                'websafeCursor': next_cursor.urlsafe()},
+                url='/tasks/update_organizer_display_name'
+            )
+
+
+    @staticmethod
+    @ndb.transactional()
+    def _setOrganizerDisplayName(c_key, displayName):
+        """Set organizerDisplayName of a Conference, in a transaction so a
+        concurrent registration's seat count isn't overwritten; returns
+        True if it changed."""
+        conf = c_key.get()
+        if not conf or conf.organizerDisplayName == displayName:
+            return False
+        conf.organizerDisplayName = displayName
+        ConferenceApi._putConference(conf)
+        return True
+
+
+    @staticmethod
+    def _backfillOrganizerDisplayNames(websafeCursor=None):
+        """Fill organizerDisplayName of a batch of Conferences written
+        before it was stored, from their organizers' Profiles; used by the
+        backfill_organizer_display_names task, which re-enqueues itself
+        until every conference is done."""
+        cursor = Cursor(urlsafe=websafeCursor) if websafeCursor else None
+        confs, next_cursor, more = Conference.query().fetch_page(
+            ORGANIZER_NAME_BATCH_SIZE, start_cursor=cursor)
+
+        missing = [conf for conf in confs if conf.organizerDisplayName is None]
+        profiles = ndb.get_multi([conf.key.parent() for conf in missing])
+        changed = [ConferenceApi._setOrganizerDisplayName(conf.key, prof.displayName)
+                   for conf, prof in zip(missing, profiles) if prof]
+        if any(changed):
+            ConferenceApi._bumpConferencesGeneration()
+
+        if more and next_cursor:
+            taskqueue.add(params={'websafeCursor': next_cursor.urlsafe()},
+                url='/tasks/backfill_organizer_display_names'
+            )
+
+
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
     @staticmethod
@@ -442,95 +1370,895 @@ class ConferenceApi(remote.Service):
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
-        retval = None
-        prof = self._getProfileFromUser() # get user Profile
-
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
+        conf = keyFromUrlsafe(wsck).get()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
+        return self._registrationTransaction(request, conf, reg)
+
+
+    @txstats.transactional('conferenceRegistration',
+                           lambda self, request, conf, reg=True: organizerGroup(
+                               request.websafeConferenceKey), xg=True)
+    def _registrationTransaction(self, request, conf, reg=True):
+        """Register or unregister user for conf, read beforehand."""
+        retval = None
+        prof = self._getProfileFromUser() # get user Profile
+        wsck = request.websafeConferenceKey
+
+        # seats of sharded conferences are taken from a SeatShard, and
+        # seatShards never changes, so the Conference (organizer's entity
+        # group) stays out of the transaction; other seats are on the
+        # Conference itself, read again here
+        if conf.seatShards:
+            seats = self._pickSeatShard(conf, reg)
+        else:
+            conf = seats = conf.key.get()
+            if not conf:
+                raise endpoints.NotFoundException(
+                    'No conference found with key: %s' % wsck)
+
+        # registered if the user's Registration for conf exists
+        r_key = self._registrationKey(prof.key, wsck)
+        registration = r_key.get()
 
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if registration:
                 raise ConflictException(
                     "You have already registered for this conference")
 
             # check if seats avail
-            if conf.seatsAvailable <= 0:
+            if not seats or seats.seatsAvailable <= 0:
                 raise ConflictException(
-                    "There are no seats available.")
+                    "There are no seats available; join the waitlist.")
 
             # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
+            Registration(key=r_key, conferenceKey=conf.key).put()
+            seats.seatsAvailable -= 1
             retval = True
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if registration:
 
                 # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
+                r_key.delete()
+                seats.seatsAvailable += 1
                 retval = True
             else:
                 retval = False
 
         # write things back to the datastore & return
-        prof.put()
-        conf.put()
+        self._recordOutcome(prof.key, request, 'register' if reg else 'unregister',
+                            retval)
+        if retval and conf.seatShards:
+            seats.put()
+            ndb.get_context().call_on_commit(
+                lambda: self._seatShardsChanged(wsck, -1 if reg else 1))
+        elif retval:
+            self._putConference(conf)
+            ndb.get_context().call_on_commit(self._bumpConferencesGeneration)
+            ndb.get_context().call_on_commit(
+                lambda: self._cachedSeatsChanged(wsck, -1 if reg else 1))
+        if retval and not reg:
+            # freed seat goes to the waitlist, if anyone is waiting
+            ndb.get_context().call_on_commit(
+                lambda: self._schedulePromotion(wsck))
         return BooleanMessage(data=retval)
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    def _idempotencyKey(self, request):
+        """Return idempotencyKey parameter or Idempotency-Key header, or None."""
+        value = request.idempotencyKey
+        if not value:
+            headers = getattr(getattr(self, 'request_state', None), 'headers', None)
+            value = headers.get('Idempotency-Key') if headers else None
+        if value and len(value) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            raise endpoints.BadRequestException(
+                "Idempotency key must be at most %d characters." %
+                IDEMPOTENCY_KEY_MAX_LENGTH)
+        return value or None
+
+
+    @staticmethod
+    def _idempotencyRecordKey(p_key, action, request, idempotency_key):
+        """Return key of the IdempotencyRecord for an action on a conference."""
+        return ndb.Key(IdempotencyRecord, '%s:%s:%s' % (
+            action, request.websafeConferenceKey, idempotency_key), parent=p_key)
+
+
+    def _replayOutcome(self, request, action):
+        """Return BooleanMessage recorded for request's idempotency key, from
+        memcache or else the datastore, or None if there is none; replays
+        open no transaction."""
+        idempotency_key = self._idempotencyKey(request)
+        if not idempotency_key:
+            return None
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        i_key = self._idempotencyRecordKey(ndb.Key(Profile, getUserId(user)),
+                                           action, request, idempotency_key)
+        memcache_key = MEMCACHE_IDEMPOTENCY_TPL % (i_key.parent().id(), i_key.id())
+        result = memcache.get(memcache_key)
+        if result is None:
+            record = i_key.get()
+            if not record:
+                return None
+            result = record.result
+            memcache.set(memcache_key, result, time=IDEMPOTENCY_TIMEOUT)
+        return BooleanMessage(data=result)
+
+
+    def _recordOutcome(self, p_key, request, action, result):
+        """Record result for request's idempotency key, if it has one, in
+        the current transaction; cached in memcache once it commits."""
+        idempotency_key = self._idempotencyKey(request)
+        if not idempotency_key:
+            return
+        i_key = self._idempotencyRecordKey(p_key, action, request, idempotency_key)
+        IdempotencyRecord(key=i_key, result=result).put()
+        ndb.get_context().call_on_commit(lambda: memcache.set(
+            MEMCACHE_IDEMPOTENCY_TPL % (p_key.id(), i_key.id()), result,
+            time=IDEMPOTENCY_TIMEOUT))
+
+
+    @staticmethod
+    def _expireIdempotencyRecords():
+        """Delete IdempotencyRecords older than IDEMPOTENCY_RETENTION_DAYS;
+        used by the expire_idempotency_records cron."""
+        cutoff = datetime.utcnow() - timedelta(days=IDEMPOTENCY_RETENTION_DAYS)
+        q = IdempotencyRecord.query(IdempotencyRecord.created < cutoff)
+        while True:
+            keys = q.fetch(IDEMPOTENCY_EXPIRE_BATCH_SIZE, keys_only=True)
+            ndb.delete_multi(keys)
+            if len(keys) < IDEMPOTENCY_EXPIRE_BATCH_SIZE:
+                break
+
+
+    @staticmethod
+    def _registrationKey(p_key, wsck):
+        """Return key of Profile p_key's Registration for a conference."""
+        return ndb.Key(Registration, wsck, parent=p_key)
+
+
+    @staticmethod
+    def _seatShardKeys(c_key, count):
+        """Return keys of a Conference's SeatShards."""
+        wsck = urlsafeFromKey(c_key)
+        return [ndb.Key(SeatShard, '%s:%d' % (wsck, i)) for i in range(count)]
+
+
+    def _pickSeatShard(self, conf, reg):
+        """Return SeatShard to take a seat from (reg) or give one back to.
+        Runs in the registration transaction: shards are read in random
+        order until one has a seat, so None means truly sold out."""
+        keys = self._seatShardKeys(conf.key, conf.seatShards)
+        random.shuffle(keys)
+        if not reg:
+            return keys[0].get() or SeatShard(key=keys[0])
+        # cached total lets sold-out conferences fail without reading shards
+        if memcache.get(MEMCACHE_SEATS_TPL % urlsafeFromKey(conf.key)) == 0:
+            return None
+        for key in keys:
+            shard = key.get()
+            if shard and shard.seatsAvailable > 0:
+                return shard
+        return None
+
+
+    @staticmethod
+    def _cachedSeatsChanged(wsck, delta):
+        """Adjust the memcache copy of a conference's available seats, if
+        cached, by delta; call once the seat change commits."""
+        key = MEMCACHE_SEATS_TPL % wsck
+        if delta > 0:
+            memcache.incr(key, delta)
+        else:
+            memcache.decr(key, -delta)
+
+
+    @staticmethod
+    def _seatShardsChanged(wsck, delta):
+        """Adjust cached seat total & schedule a Conference.seatsAvailable
+        sync; at most one sync task per conference per interval."""
+        ConferenceApi._cachedSeatsChanged(wsck, delta)
+        window = int(time.time() // SEAT_SYNC_INTERVAL)
+        try:
+            taskqueue.add(params={'websafeConferenceKey': wsck},
+                url='/tasks/sync_seats',
+                name='sync-seats-%s-%d' % (wsck, window),
+                countdown=SEAT_SYNC_INTERVAL
+            )
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+
+    @staticmethod
+    def _syncSeats(wsck):
+        """Copy total of a Conference's SeatShards to its seatsAvailable &
+        the memcache total; used by the sync_seats task."""
+        conf = keyFromUrlsafe(wsck).get()
+        if not conf or not conf.seatShards:
+            return
+        shards = ndb.get_multi(ConferenceApi._seatShardKeys(conf.key, conf.seatShards))
+        total = sum(shard.seatsAvailable for shard in shards if shard)
+        memcache.set(MEMCACHE_SEATS_TPL % wsck, total, time=SEATS_CACHE_TIMEOUT)
+
+        @ndb.transactional()
+        def update():
+            conf = keyFromUrlsafe(wsck).get()
+            if conf.seatsAvailable != total:
+                conf.seatsAvailable = total
+                ConferenceApi._putConference(conf)
+                ndb.get_context().call_on_commit(ConferenceApi._bumpConferencesGeneration)
+        if conf.seatsAvailable != total:
+            update()
+
+
+    @staticmethod
+    def _adjustSeatShards(wsck, delta, version):
+        """Add delta seats to a Conference's SeatShards after maxAttendees
+        changed in Conference version; removes only seats still available.
+        Used by the adjust_seat_shards task. Each shard remembers what it
+        applied for recent versions, so a retried task changes nothing."""
+        conf = keyFromUrlsafe(wsck).get()
+        if not conf or not conf.seatShards:
+            return
+
+        @ndb.transactional()
+        def adjust(key, delta):
+            shard = key.get() or SeatShard(key=key)
+            for adjustment in shard.adjustments:
+                applied_version, applied = map(int, adjustment.split(':'))
+                if applied_version == version:
+                    return applied
+            delta = max(delta, -shard.seatsAvailable)
+            shard.seatsAvailable += delta
+            shard.adjustments = (shard.adjustments +
+                ['%d:%d' % (version, delta)])[-SEAT_ADJUSTMENTS_LIMIT:]
+            shard.put()
+            return delta
+
+        keys = ConferenceApi._seatShardKeys(conf.key, conf.seatShards)
+        if delta > 0:
+            adjust(keys[0], delta)
+        for key in keys:
+            if delta >= 0:
+                break
+            delta -= adjust(key, delta)
+        ConferenceApi._syncSeats(wsck)
+
+
+    @endpoints.method(CONF_LIST_REQUEST, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser() # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
-
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        fields = self._fieldMask(request.fields)
+        r_keys, cursor, more = self._fetchPage(
+            Registration.query(ancestor=prof.key),
+            request.pageSize, request.pageToken, keys_only=True)
+        conferences = ndb.get_multi([keyFromUrlsafe(r_key.id()) for r_key in r_keys])
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
-         for conf in conferences]
-        )
+        return ConferenceForms(
+            items=converterFor(Conference, ConferenceForm, fields).convert_many(
+                [conf for conf in conferences if conf]),
+            nextPageToken=cursor.urlsafe() if more and cursor else None)
 
 
-    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+    @endpoints.method(CONF_MUTATE_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='POST', name='registerForConference')
     def registerForConference(self, request):
         """Register user for selected conference."""
-        return self._conferenceRegistration(request)
+        replay = self._replayOutcome(request, 'register')
+        if replay is not None:
+            return replay
 
+        # seats held by others are not for the taking
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+        wsck = request.websafeConferenceKey
+        held = memcache.get(MEMCACHE_SEAT_HOLD_TPL % (wsck, user_id)) is not None
+        if not held:
+            if self._waitlisted(wsck):
+                raise ConflictException(
+                    "Others are waiting for a seat; join the waitlist.")
+            holds = self._heldSeats(wsck)
+            if holds and self._cachedSeatsAvailable(wsck) <= holds:
+                raise ConflictException(
+                    "All remaining seats are held; join the waitlist.")
 
-    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+        result = self._conferenceRegistration(request)
+        if held:
+            self._releaseHold(wsck, user_id)
+        return result
+
+
+    @endpoints.method(CONF_MUTATE_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='DELETE', name='unregisterFromConference')
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
+        replay = self._replayOutcome(request, 'unregister')
+        if replay is not None:
+            return replay
         return self._conferenceRegistration(request, reg=False)
 
 
+# - - - Queued registration - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _claimId(wsck, user_id):
+        """Return key name of a user's RegistrationClaim for a conference."""
+        return '%s:%s' % (wsck, user_id)
+
+
+    def _copyClaimToForm(self, claim):
+        """Copy relevant fields from RegistrationClaim to ClaimForm."""
+        return ClaimForm(websafeConferenceKey=urlsafeFromKey(claim.conferenceKey),
+                         status=getattr(ClaimStatus, claim.status))
+
+
+    @staticmethod
+    @ndb.transactional()
+    def _queueClaim(wsck, user_id):
+        """Return user's pending RegistrationClaim for a conference, making
+        one & adding it to the claim queue if there is none."""
+        c_key = ndb.Key(RegistrationClaim, ConferenceApi._claimId(wsck, user_id))
+        claim = c_key.get()
+        if claim and claim.status == 'PENDING':
+            return claim
+        claim = RegistrationClaim(key=c_key, conferenceKey=keyFromUrlsafe(wsck),
+                                  userId=user_id)
+        claim.put()
+        taskqueue.Queue(CLAIM_QUEUE).add(
+            taskqueue.Task(payload=c_key.id(), method='PULL', tag=wsck),
+            transactional=True)
+        return claim
+
+
+    @staticmethod
+    def _scheduleClaimDrain(wsck, named=True, countdown=CLAIM_DRAIN_INTERVAL):
+        """Add a drain task for a conference's claims; named tasks allow one
+        per conference per CLAIM_DRAIN_INTERVAL, and run after it ends."""
+        name = None
+        if named:
+            name = 'drain-claims-%s-%d' % (wsck, int(time.time() // CLAIM_DRAIN_INTERVAL))
+        try:
+            taskqueue.add(params={'websafeConferenceKey': wsck},
+                url='/tasks/drain_registration_claims',
+                name=name,
+                countdown=countdown
+            )
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+
+    @staticmethod
+    @txstats.transactional('takeSeats',
+                           lambda wsck, batch_id, claim_ids: organizerGroup(wsck), xg=True)
+    def _takeSeats(wsck, batch_id, claim_ids):
+        """Take one seat per claim id, in order, in a single transaction,
+        returning the ids granted. Recorded as a ClaimBatch so a retried
+        drain gets the same answer without taking seats again."""
+        b_key = ndb.Key(ClaimBatch, batch_id)
+        batch = b_key.get()
+        if batch:
+            return batch.granted
+        conf = keyFromUrlsafe(wsck).get()
+        if conf.seatShards:
+            seats = [shard for shard in ndb.get_multi(ConferenceApi._seatShardKeys(
+                conf.key, conf.seatShards)) if shard]
+        else:
+            seats = [conf]
+
+        granted = []
+        taken = []
+        for entity in seats:
+            take = min(entity.seatsAvailable, len(claim_ids) - len(granted))
+            if take <= 0:
+                continue
+            entity.seatsAvailable -= take
+            granted.extend(claim_ids[len(granted):len(granted) + take])
+            taken.append(entity)
+
+        if taken and conf.seatShards:
+            ndb.put_multi(taken)
+            ndb.get_context().call_on_commit(
+                lambda: ConferenceApi._seatShardsChanged(wsck, -len(granted)))
+        elif taken:
+            ConferenceApi._putConference(conf)
+            ndb.get_context().call_on_commit(ConferenceApi._bumpConferencesGeneration)
+            ndb.get_context().call_on_commit(
+                lambda: ConferenceApi._cachedSeatsChanged(wsck, -len(granted)))
+        ClaimBatch(key=b_key, granted=granted).put()
+        return granted
+
+
+    @staticmethod
+    def _drainRegistrationClaims(wsck):
+        """Apply up to CLAIM_BATCH_SIZE queued claims for a conference, first
+        come first served, taking their seats in one transaction; used by
+        the drain_registration_claims task."""
+        queue = taskqueue.Queue(CLAIM_QUEUE)
+        tasks = queue.lease_tasks_by_tag(CLAIM_LEASE_SECONDS, CLAIM_BATCH_SIZE, tag=wsck)
+        if not tasks:
+            return
+        # if this drain dies without releasing its leases, the claims are
+        # drained again once the leases run out
+        ConferenceApi._scheduleClaimDrain(wsck, named=False,
+                                          countdown=CLAIM_LEASE_SECONDS + CLAIM_DRAIN_INTERVAL)
+        try:
+            ConferenceApi._applyClaims(wsck, tasks)
+        except Exception:
+            # let the task retry lease them again at once
+            for task in tasks:
+                queue.modify_task_lease(task, 0)
+            raise
+        queue.delete_tasks(tasks)
+
+        # a full batch may have left more claims behind
+        if len(tasks) == CLAIM_BATCH_SIZE:
+            ConferenceApi._scheduleClaimDrain(wsck, named=False)
+
+
+    @staticmethod
+    def _applyClaims(wsck, tasks):
+        """Take seats for & settle the pending claims of leased tasks."""
+        c_keys = set(ndb.Key(RegistrationClaim, task.payload) for task in tasks)
+        claims = sorted((claim for claim in ndb.get_multi(list(c_keys))
+                         if claim and claim.status == 'PENDING'),
+                        key=lambda claim: claim.created)
+
+        # users who registered directly since claiming need no seat
+        r_keys = [ConferenceApi._registrationKey(ndb.Key(Profile, claim.userId), wsck)
+                  for claim in claims]
+        registered = set(r.key for r in ndb.get_multi(r_keys) if r)
+
+        # claims stamped by an earlier drain whose seat transaction
+        # committed keep its outcome, whatever tasks are leased now
+        b_keys = list(set(ndb.Key(ClaimBatch, claim.batchId)
+                          for claim in claims if claim.batchId))
+        earlier = dict((batch.key.id(), set(batch.granted))
+                       for batch in ndb.get_multi(b_keys) if batch)
+        granted = set(claim.key.id() for claim in claims
+                      if claim.key.id() in earlier.get(claim.batchId, ()))
+        todo = [claim for claim, r_key in zip(claims, r_keys)
+                if r_key not in registered and claim.batchId not in earlier]
+
+        if todo:
+            # stamp claims before their seats are taken
+            batch_id = uuid.uuid4().hex
+            for claim in todo:
+                claim.batchId = batch_id
+            ndb.put_multi(todo)
+            granted.update(ConferenceApi._takeSeats(wsck, batch_id,
+                [claim.key.id() for claim in todo]))
+            b_keys.append(ndb.Key(ClaimBatch, batch_id))
+
+        registrations = []
+        for claim, r_key in zip(claims, r_keys):
+            if claim.key.id() in granted:
+                registrations.append(Registration(key=r_key,
+                                                  conferenceKey=claim.conferenceKey))
+            claim.status = 'REGISTERED' if claim.key.id() in granted or \
+                r_key in registered else 'REJECTED'
+        ndb.put_multi(registrations + claims)
+        # settled claims no longer need their batches
+        ndb.delete_multi(b_keys)
+
+
+    @endpoints.method(CONF_GET_REQUEST, ClaimForm,
+            path='conference/{websafeConferenceKey}/claim',
+            http_method='POST', name='claimConferenceSeat')
+    def claimConferenceSeat(self, request):
+        """Queue a claim for a seat at selected conference; for ticket
+        launches, where claims are applied in batches. Poll
+        getConferenceSeatClaim for the outcome."""
+        prof = self._getProfileFromUser() # get user Profile
+        wsck = request.websafeConferenceKey
+        if not keyFromUrlsafe(wsck).get():
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        if self._registrationKey(prof.key, wsck).get():
+            raise ConflictException(
+                "You have already registered for this conference")
+
+        claim = self._queueClaim(wsck, prof.key.id())
+        self._scheduleClaimDrain(wsck)
+        return self._copyClaimToForm(claim)
+
+
+    @endpoints.method(CONF_GET_REQUEST, ClaimForm,
+            path='conference/{websafeConferenceKey}/claim',
+            http_method='GET', name='getConferenceSeatClaim')
+    def getConferenceSeatClaim(self, request):
+        """Return status of user's queued claim for selected conference."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        wsck = request.websafeConferenceKey
+        claim = ndb.Key(RegistrationClaim, self._claimId(wsck, getUserId(user))).get()
+        if not claim:
+            raise endpoints.NotFoundException(
+                'No claim found for conference: %s' % wsck)
+        return self._copyClaimToForm(claim)
+
+
+# - - - Seat holds - - - - - - - - - - - - - - - - - - - - -
+
+    def _cachedSeatsAvailable(self, wsck):
+        """Return seatsAvailable of a conference from memcache, getting the
+        Conference only if it is not cached."""
+        key = MEMCACHE_SEATS_TPL % wsck
+        seats = memcache.get(key)
+        if seats is None:
+            conf = keyFromUrlsafe(wsck).get()
+            if not conf:
+                raise endpoints.NotFoundException(
+                    'No conference found with key: %s' % wsck)
+            seats = conf.seatsAvailable or 0
+            memcache.add(key, seats, time=SEATS_CACHE_TIMEOUT)
+        return int(seats)
+
+
+    @staticmethod
+    def _heldSeats(wsck):
+        """Return number of live seat holds for a conference."""
+        return int(memcache.get(MEMCACHE_SEAT_HOLDS_TPL % wsck) or 0)
+
+
+    @staticmethod
+    def _registerHoldConference(wsck, bucket):
+        """Add conference to those release_seat_holds visits, once per
+        bucket per instance."""
+        if holdConferences.get(wsck) == bucket:
+            return
+        client = memcache.Client()
+        for _ in range(3):
+            confs = client.gets(MEMCACHE_SEAT_HOLD_CONFERENCES_KEY)
+            if confs is None:
+                if client.add(MEMCACHE_SEAT_HOLD_CONFERENCES_KEY, {wsck: bucket}):
+                    break
+                continue
+            confs[wsck] = max(bucket, confs.get(wsck, bucket))
+            if client.cas(MEMCACHE_SEAT_HOLD_CONFERENCES_KEY, confs):
+                break
+        holdConferences[wsck] = bucket
+
+
+    @staticmethod
+    def _releaseHold(wsck, user_id):
+        """Release user's seat hold, if still live; returns True if so."""
+        hold_key = MEMCACHE_SEAT_HOLD_TPL % (wsck, user_id)
+        hold = memcache.get(hold_key)
+        # only the caller that deletes the hold gives its seat back
+        if hold is None or memcache.delete(hold_key) != memcache.DELETE_SUCCESSFUL:
+            return False
+        memcache.decr(MEMCACHE_SEAT_HOLDS_TPL % wsck)
+        memcache.decr(MEMCACHE_SEAT_HOLD_BUCKET_TPL % (wsck, hold[0]))
+        return True
+
+
+    @staticmethod
+    def _releaseExpiredHolds():
+        """Give back the seats of expired holds, a whole bucket at a time,
+        & refresh cached seatsAvailable of conferences with live holds;
+        used by the release_seat_holds cron. The live hold count is reset
+        to the sum of the live buckets, so counts lost to eviction or a
+        missed run do not hold seats for good."""
+        confs = memcache.get(MEMCACHE_SEAT_HOLD_CONFERENCES_KEY) or {}
+        now = time.time()
+        # every hold made in this bucket or before has expired
+        expired = int((now - SEAT_HOLD_SECONDS) // SEAT_HOLD_BUCKET_SECONDS) - 1
+        current = int(now // SEAT_HOLD_BUCKET_SECONDS)
+        buckets = range(expired - SEAT_HOLD_LOOKBACK, expired + 1)
+        done = []
+        live = []
+        for wsck, last_bucket in confs.items():
+            memcache.delete_multi([MEMCACHE_SEAT_HOLD_BUCKET_TPL % (wsck, bucket)
+                                   for bucket in buckets])
+            counts = memcache.get_multi([MEMCACHE_SEAT_HOLD_BUCKET_TPL % (wsck, bucket)
+                                         for bucket in range(expired + 1, current + 1)])
+            # holds made or released between the read & the set are
+            # off by one until the next run
+            memcache.set(MEMCACHE_SEAT_HOLDS_TPL % wsck,
+                         sum(max(int(count), 0) for count in counts.values()),
+                         time=SEAT_HOLD_COUNTER_TIMEOUT)
+            if last_bucket <= expired:
+                done.append(wsck)
+            else:
+                live.append(wsck)
+
+        # holds are checked against seatsAvailable; keep it fresh
+        conferences = ndb.get_multi([keyFromUrlsafe(wsck) for wsck in live])
+        memcache.set_multi(dict((MEMCACHE_SEATS_TPL % wsck, conf.seatsAvailable or 0)
+            for wsck, conf in zip(live, conferences) if conf and not conf.seatShards),
+            time=SEATS_CACHE_TIMEOUT)
+
+        if done:
+            client = memcache.Client()
+            for _ in range(3):
+                confs = client.gets(MEMCACHE_SEAT_HOLD_CONFERENCES_KEY)
+                if confs is None:
+                    break
+                for wsck in done:
+                    if confs.get(wsck, expired + 1) <= expired:
+                        del confs[wsck]
+                if client.cas(MEMCACHE_SEAT_HOLD_CONFERENCES_KEY, confs):
+                    break
+            for wsck in done:
+                holdConferences.pop(wsck, None)
+
+
+    @endpoints.method(CONF_GET_REQUEST, HoldForm,
+            path='conference/{websafeConferenceKey}/hold',
+            http_method='POST', name='holdSeat')
+    def holdSeat(self, request):
+        """Hold a seat at selected conference for SEAT_HOLD_SECONDS while
+        the user checks out; registerForConference then uses it. Holds
+        live in memcache, so no transaction is run."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+        wsck = request.websafeConferenceKey
+
+        hold_key = MEMCACHE_SEAT_HOLD_TPL % (wsck, user_id)
+        hold = memcache.get(hold_key)
+        if hold is None:
+            if self._registrationKey(ndb.Key(Profile, user_id), wsck).get():
+                raise ConflictException(
+                    "You have already registered for this conference")
+            if self._waitlisted(wsck):
+                raise ConflictException(
+                    "Others are waiting for a seat; join the waitlist.")
+            seats = self._cachedSeatsAvailable(wsck)
+            holds_key = MEMCACHE_SEAT_HOLDS_TPL % wsck
+            # incr's initial_value would make counters that never expire
+            memcache.add(holds_key, 0, time=SEAT_HOLD_COUNTER_TIMEOUT)
+            if memcache.incr(holds_key, initial_value=0) > seats:
+                memcache.decr(holds_key)
+                raise ConflictException(
+                    "There are no seats left to hold; join the waitlist.")
+            now = time.time()
+            bucket = int(now // SEAT_HOLD_BUCKET_SECONDS)
+            bucket_key = MEMCACHE_SEAT_HOLD_BUCKET_TPL % (wsck, bucket)
+            memcache.add(bucket_key, 0, time=SEAT_HOLD_COUNTER_TIMEOUT)
+            memcache.incr(bucket_key, initial_value=0)
+            hold = (bucket, now + SEAT_HOLD_SECONDS)
+            memcache.set(hold_key, hold, time=SEAT_HOLD_SECONDS)
+            self._registerHoldConference(wsck, bucket)
+        return HoldForm(websafeConferenceKey=wsck,
+            expires=datetime.utcfromtimestamp(hold[1]).isoformat() + 'Z')
+
+
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+            path='conference/{websafeConferenceKey}/hold',
+            http_method='DELETE', name='releaseSeat')
+    def releaseSeat(self, request):
+        """Release user's seat hold for selected conference."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        return BooleanMessage(data=self._releaseHold(
+            request.websafeConferenceKey, getUserId(user)))
+
+
+# - - - Bulk registration - - - - - - - - - - - - - - - - - -
+
+    def _bulkRegister(self, wsck, user_ids, import_id=None):
+        """Register user_ids for a conference in chunks, each taking its
+        seats in one transaction and writing its Registrations in one
+        batch; returns (distinct user ids, {userId: RegistrationOutcome}).
+        A retry with the same import_id gets the seats already taken by
+        a chunk that failed before its Registrations were written."""
+        c_key = keyFromUrlsafe(wsck)
+        import_id = import_id or uuid.uuid4().hex
+        outcomes = {}
+        futures = []
+        b_keys = []
+        # drop repeats, keeping import order
+        user_ids = list(OrderedDict.fromkeys(uid for uid in user_ids if uid))
+        # a chunk that raises must not leave earlier chunks' puts unawaited:
+        # this isn't a toplevel request, so they would be dropped
+        try:
+            for start in range(0, len(user_ids), BULK_REGISTRATION_CHUNK):
+                chunk = user_ids[start:start + BULK_REGISTRATION_CHUNK]
+                r_keys = [self._registrationKey(ndb.Key(Profile, uid), wsck)
+                          for uid in chunk]
+                registered = set(r.key.parent().id() for r in ndb.get_multi(r_keys) if r)
+                pending = [uid for uid in chunk if uid not in registered]
+                granted = set()
+                if pending:
+                    batch_id = hashlib.sha1(
+                        (u'%s|%s|%d' % (wsck, import_id, start)).encode('utf-8')).hexdigest()
+                    granted = set(self._takeSeats(wsck, batch_id, pending))
+                    b_keys.append(ndb.Key(ClaimBatch, batch_id))
+                futures.extend(ndb.put_multi_async(
+                    [Registration(key=r_key, conferenceKey=c_key)
+                     for uid, r_key in zip(chunk, r_keys) if uid in granted]))
+                for uid in chunk:
+                    if uid in registered:
+                        outcomes[uid] = RegistrationOutcome.ALREADY_REGISTERED
+                    elif uid in granted:
+                        outcomes[uid] = RegistrationOutcome.REGISTERED
+                    else:
+                        outcomes[uid] = RegistrationOutcome.NO_SEAT
+        finally:
+            ndb.Future.wait_all(futures)
+        for future in futures:
+            future.check_success()
+        # Registrations now tell a retry who has a seat
+        ndb.delete_multi(b_keys)
+        return user_ids, outcomes
+
+
+    @endpoints.method(CONF_BULK_REGISTER_REQUEST, RegistrationResultForms,
+            path='conference/{websafeConferenceKey}/attendees',
+            http_method='POST', name='registerAttendees')
+    def registerAttendees(self, request):
+        """Register a list of users for selected conference (by organizer)."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        wsck = request.websafeConferenceKey
+        conf = keyFromUrlsafe(wsck).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can register attendees.')
+
+        user_ids, outcomes = self._bulkRegister(wsck, list(request.userIds),
+                                                request.importId)
+        return RegistrationResultForms(items=[RegistrationResultForm(
+            userId=uid, outcome=outcomes[uid]) for uid in user_ids])
+
+
+# - - - Waitlist - - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _schedulePromotion(wsck, named=True):
+        """Add a waitlist promotion task for a conference; named tasks allow
+        one per conference per WAITLIST_PROMOTE_INTERVAL."""
+        name = None
+        if named:
+            name = 'promote-waitlist-%s-%d' % (
+                wsck, int(time.time() // WAITLIST_PROMOTE_INTERVAL))
+        try:
+            taskqueue.add(params={'websafeConferenceKey': wsck},
+                url='/tasks/promote_waitlist',
+                name=name,
+                countdown=WAITLIST_PROMOTE_INTERVAL
+            )
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+
+    @staticmethod
+    def _promoteWaitlist(wsck):
+        """Register the first WAITLIST_BATCH_SIZE users waiting for a
+        conference, as far as seats allow, taking their seats in one
+        transaction; used by the promote_waitlist task."""
+        c_key = keyFromUrlsafe(wsck)
+        # the query is only eventually consistent, so it just picks the
+        # entries; they are read by key before any seat is granted, and
+        # those already gone (left the waitlist) are skipped
+        e_keys = WaitlistEntry.query(WaitlistEntry.conferenceKey == c_key).order(
+            WaitlistEntry.created).fetch(WAITLIST_BATCH_SIZE, keys_only=True)
+        entries = [entry for entry in ndb.get_multi(e_keys) if entry]
+        if not entries:
+            if len(e_keys) == WAITLIST_BATCH_SIZE:
+                ConferenceApi._schedulePromotion(wsck, named=False)
+            return
+
+        # users who registered directly since joining need no seat
+        r_keys = [ConferenceApi._registrationKey(entry.key.parent(), wsck)
+                  for entry in entries]
+        registered = set(r.key for r in ndb.get_multi(r_keys) if r)
+        waiting = [entry for entry, r_key in zip(entries, r_keys)
+                   if r_key not in registered]
+        granted = set()
+        b_key = None
+        if waiting:
+            granted, b_key = ConferenceApi._grantWaiting(wsck, waiting)
+
+        promoted = [entry for entry in waiting
+                    if entry.key.parent().id() in granted]
+        ndb.put_multi([Registration(key=ConferenceApi._registrationKey(
+            entry.key.parent(), wsck), conferenceKey=c_key) for entry in promoted])
+        ndb.delete_multi([entry.key for entry, r_key in zip(entries, r_keys)
+                          if r_key in registered or entry.key.parent().id() in granted])
+        # Registrations & entries now tell a retry who has a seat; a kept
+        # batch would answer the next run for the same entries, even one
+        # granting nothing, without taking the seats freed since
+        if b_key:
+            b_key.delete()
+
+        # seats were left for a full batch, so more may be waiting
+        if len(promoted) == len(waiting) and len(e_keys) == WAITLIST_BATCH_SIZE:
+            ConferenceApi._schedulePromotion(wsck, named=False)
+
+
+    @staticmethod
+    def _waitlisted(wsck):
+        """Return True if anyone is on a conference's waitlist; freed seats
+        then go to them in order, not to whoever asks first."""
+        return WaitlistEntry.query(
+            WaitlistEntry.conferenceKey == keyFromUrlsafe(wsck)).get(keys_only=True) is not None
+
+
+    @staticmethod
+    def _grantWaiting(wsck, waiting):
+        """Take seats for waitlist entries, in order; returns (set of the
+        user ids granted one, key of the ClaimBatch recording it)."""
+        # a retry sees the same entries, so it gets the same batch id
+        batch_id = hashlib.sha1(','.join('%s@%s' % (entry.key.parent().id(),
+            entry.created) for entry in waiting)).hexdigest()
+        granted = set(ConferenceApi._takeSeats(wsck, batch_id,
+            [entry.key.parent().id() for entry in waiting]))
+        return granted, ndb.Key(ClaimBatch, batch_id)
+
+
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+            path='conference/{websafeConferenceKey}/waitlist',
+            http_method='POST', name='joinWaitlist')
+    def joinWaitlist(self, request):
+        """Join waitlist for selected conference; users are registered in
+        the order they joined as seats free up."""
+        prof = self._getProfileFromUser() # get user Profile
+        wsck = request.websafeConferenceKey
+        conf = keyFromUrlsafe(wsck).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        if self._registrationKey(prof.key, wsck).get():
+            raise ConflictException(
+                "You have already registered for this conference")
+
+        w_key = ndb.Key(WaitlistEntry, wsck, parent=prof.key)
+        if w_key.get():
+            return BooleanMessage(data=False)
+        WaitlistEntry(key=w_key, conferenceKey=conf.key).put()
+        if conf.seatsAvailable > 0:
+            self._schedulePromotion(wsck)
+        return BooleanMessage(data=True)
+
+
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+            path='conference/{websafeConferenceKey}/waitlist',
+            http_method='DELETE', name='leaveWaitlist')
+    def leaveWaitlist(self, request):
+        """Leave waitlist for selected conference."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        w_key = ndb.Key(WaitlistEntry, request.websafeConferenceKey,
+                        parent=ndb.Key(Profile, getUserId(user)))
+        if not w_key.get():
+            return BooleanMessage(data=False)
+        w_key.delete()
+        return BooleanMessage(data=True)
+
+
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='filterPlayground',
             http_method='GET', name='filterPlayground')
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""
+converters.py -- datastore entity to ProtoRPC form converters, worked out
+    once per (model, message) pair instead of walking all_fields() with
+    hasattr()/endswith() checks for every entity
+
+"""
+
+from protorpc import messages
+from google.appengine.ext import ndb
+
+from keycache import urlsafeFromKey
+
+# (model, message, field mask) -> FormConverter
+_converters = {}
+
+
+class FormConverter(object):
+    """Copies the fields a model and message share: dates become date
+    strings, strings become enums for EnumFields, and websafeKey is
+    filled from the entity key if the message has one.  If fields is
+    given, only those message fields are filled."""
+
+    def __init__(self, model, message, fields=None):
+        self._message = message
+        self._copies = []
+        self._websafeKey = False
+        for field in sorted(message.all_fields(), key=lambda f: f.number):
+            if fields is not None and field.name not in fields:
+                continue
+            prop = model._properties.get(field.name)
+            if prop is None:
+                if field.name == 'websafeKey':
+                    self._websafeKey = True
+                continue
+            if isinstance(prop, ndb.DateTimeProperty):
+                convert = str           # convert Date to date string
+            elif isinstance(field, messages.EnumField):
+                convert = field.type.lookup_by_name
+            else:
+                convert = None          # just copy
+            self._copies.append((field.name, convert))
+        self._required = any(field.required for field in message.all_fields())
+
+
+    def convert(self, entity, **values):
+        """Return message for entity; values, if given, replace fields
+        the entity can't provide (e.g. those left out of a projection)."""
+        form = self._message()
+        for name, convert in self._copies:
+            value = values[name] if name in values else getattr(entity, name)
+            if convert is not None:
+                value = convert(value)
+            setattr(form, name, value)
+        if self._websafeKey:
+            form.websafeKey = urlsafeFromKey(entity.key)
+        if self._required:
+            form.check_initialized()
+        return form
+
+
+    def convert_many(self, entities, **values):
+        """Return list of messages, one per entity."""
+        convert = self.convert
+        return [convert(entity, **values) for entity in entities]
+
+
+def converterFor(model, message, fields=None):
+    """Return the (shared) FormConverter from model to message, filling
+    only the message fields named in fields if given."""
+    key = (model, message, frozenset(fields) if fields is not None else None)
+    converter = _converters.get(key)
+    if converter is None:
+        converter = _converters[key] = FormConverter(model, message, fields)
+    return converter
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+"""
+filterengine.py -- in-memory inverted index over Conference filter
+    fields; answers any conjunction of queryConferences() filters
+    (including inequalities on several fields) by set intersection
+
+"""
+
+import bisect
+import threading
+from datetime import datetime
+from datetime import timedelta
+
+from models import Conference
+
+
+class ConferenceFilterEngine(object):
+    """Per-instance index of Conferences: for every field, a posting list
+    (set of conference keys) per distinct value plus the sorted distinct
+    values, so equality is a dict lookup and inequality a bisect.
+
+    The whole catalog is read once (see warmup in main.py); after that a
+    refresh only re-reads Conferences modified since the last one, so it
+    is cheap enough to run in the request that sees a new generation.
+    That re-read is eventually consistent and can miss a write that just
+    committed; the next refresh picks it up, and one runs at least every
+    recheck seconds, so answers may lag writes by that long.
+    """
+
+    def __init__(self, fields, batch_size=500, overlap=60, recheck=30):
+        self._fields = list(fields)
+        self._batch_size = batch_size
+        # modified-since queries are eventually consistent; re-read this
+        # many seconds before the last refresh to pick up late arrivals
+        self._overlap = timedelta(seconds=overlap)
+        self._recheck = timedelta(seconds=recheck)
+        # _refreshing serializes refreshes; _lock guards the index itself
+        # and is never held across a datastore call
+        self._refreshing = threading.Lock()
+        self._lock = threading.Lock()
+        self._order = None          # key -> (name, key), for sorting results
+        self._entries = {}          # key -> {field: [values]}
+        self._postings = dict((field, {}) for field in self._fields)
+        self._values = dict((field, []) for field in self._fields)
+        self._generation = None
+        self._since = None
+
+
+    def refresh(self, generation):
+        """Bring the index up to date with generation, building it on first
+        use; returns the generation it now reflects. Queries keep reading
+        the current index while the changes are fetched."""
+        if not self._stale(generation):
+            return self._generation
+        with self._refreshing:
+            # another thread may have refreshed while we waited
+            if not self._stale(generation):
+                return self._generation
+            started = datetime.utcnow()
+            if self._order is None:
+                q = Conference.query()
+            else:
+                q = Conference.query(Conference.modified >= self._since - self._overlap)
+            confs = list(q.iter(batch_size=self._batch_size))
+            with self._lock:
+                if self._order is None:
+                    self._order = {}
+                for conf in confs:
+                    self._update(conf)
+            self._since = started
+            self._generation = generation
+            return generation
+
+
+    def _stale(self, generation):
+        """Return True if the index must be refreshed for generation."""
+        return (self._order is None or generation != self._generation or
+                datetime.utcnow() - self._since >= self._recheck)
+
+
+    def _update(self, conf):
+        """Replace conf's postings with its current values."""
+        old = self._entries.get(conf.key)
+        if old:
+            for field, values in old.iteritems():
+                for v in values:
+                    posting = self._postings[field][v]
+                    posting.discard(conf.key)
+                    if not posting:
+                        del self._postings[field][v]
+                        distinct = self._values[field]
+                        del distinct[bisect.bisect_left(distinct, v)]
+        entry = {}
+        for field in self._fields:
+            value = getattr(conf, field, None)
+            entry[field] = values = value if isinstance(value, list) else [value]
+            for v in values:
+                posting = self._postings[field].get(v)
+                if posting is None:
+                    posting = self._postings[field][v] = set()
+                    bisect.insort(self._values[field], v)
+                posting.add(conf.key)
+        self._entries[conf.key] = entry
+        self._order[conf.key] = (conf.name, conf.key)
+
+
+    def query(self, filters):
+        """Return Conference keys, ordered by name, matching all filters
+        (dicts of field/operator/value as made by _formatFilters)."""
+        with self._lock:
+            matches = [self._match(self._postings[f["field"]], self._values[f["field"]],
+                                   f["operator"], f["value"]) for f in filters]
+            if not matches:
+                result = set(self._order)
+            else:
+                # intersect starting from the most selective filter
+                matches.sort(key=len)
+                result = matches[0]
+                for match in matches[1:]:
+                    result = result & match
+                    if not result:
+                        break
+            return sorted(result, key=self._order.get)
+
+
+    def facets(self, filters, fields):
+        """Return {field: {value: count}} over Conferences matching filters."""
+        with self._lock:
+            matches = set(self._order)
+            for f in filters:
+                matches &= self._match(self._postings[f["field"]], self._values[f["field"]],
+                                       f["operator"], f["value"])
+            counts = {}
+            for field in fields:
+                counts[field] = dict((value, len(keys & matches))
+                    for value, keys in self._postings[field].iteritems() if value is not None)
+            return counts
+
+
+    @staticmethod
+    def _match(posting, values, operator, value):
+        """Return set of conference keys where field <operator> value."""
+        if operator == '=':
+            return set(posting.get(value, ()))
+        if operator == 'IN':
+            selected = [v for v in value if v in posting]
+        elif operator == '>':
+            selected = values[bisect.bisect_right(values, value):]
+        elif operator == '>=':
+            selected = values[bisect.bisect_left(values, value):]
+        elif operator == '<':
+            selected = values[:bisect.bisect_left(values, value)]
+        elif operator == '<=':
+            selected = values[:bisect.bisect_right(values, value)]
+        else:   # '!='
+            selected = [v for v in values if v != value]
+        keys = set()
+        for v in selected:
+            keys.update(posting[v])
+        return keys
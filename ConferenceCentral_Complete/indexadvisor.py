@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""
+indexadvisor.py -- records the Conference query shapes queryConferences()
+    runs, and computes the smallest set of composite indexes serving them
+    along with the index rows each Conference.put() writes before & after
+
+Every query is ordered by Conference.name, after its inequality field if
+it has one, so a shape is its set of equality fields plus that postfix.
+The datastore can merge-join several indexes sharing a postfix, so one
+(field, postfix) index per equality field serves every combination of
+those fields, instead of one composite per combination.
+
+"""
+
+import yaml
+
+from models import QueryShape
+
+SORT_FIELD = 'name'
+
+# shapes already recorded by this instance
+_recorded = set()
+
+
+def shapeId(equalities, inequality):
+    """Return canonical id of a query shape."""
+    return '%s|%s' % (','.join(sorted(equalities)), inequality or '')
+
+
+def recordShape(inequality_filter, filters):
+    """Record shape of a query built from _formatFilters() output; writes
+    at most once per shape per instance."""
+    equalities = set(f["field"] for f in filters if f["operator"] in ("=", "IN"))
+    sid = shapeId(equalities, inequality_filter)
+    if sid in _recorded:
+        return
+    QueryShape.get_or_insert(sid, equalities=sorted(equalities),
+                             inequality=inequality_filter)
+    _recorded.add(sid)
+
+
+def _postfix(inequality):
+    """Return sort order of a query with given inequality field."""
+    if inequality:
+        return (inequality, SORT_FIELD)
+    return (SORT_FIELD,)
+
+
+def requiredIndexes(equalities, inequality):
+    """Return composite indexes (property tuples) for one shape; built-in
+    single property indexes serve a bare sort."""
+    postfix = _postfix(inequality)
+    if not equalities:
+        return [postfix] if len(postfix) > 1 else []
+    return [(field,) + postfix for field in sorted(equalities)]
+
+
+def coveringIndexes(shapes):
+    """Return sorted list of composite indexes serving all shapes, given
+    as (equalities, inequality) pairs."""
+    indexes = set()
+    for equalities, inequality in shapes:
+        indexes.update(requiredIndexes(equalities, inequality))
+    return sorted(indexes)
+
+
+def isServed(equalities, inequality, indexes):
+    """Return True if indexes can serve the shape, with one composite or
+    by merge-joining indexes that share its postfix."""
+    if not requiredIndexes(equalities, inequality):
+        return True
+    postfix = _postfix(inequality)
+    covered = set()
+    for index in indexes:
+        prefix = index[:len(index) - len(postfix)]
+        if index[len(prefix):] == postfix and set(prefix) <= set(equalities):
+            covered.update(prefix)
+    return covered == set(equalities) and (bool(covered) or postfix in indexes)
+
+
+def loadIndexes(path, kind='Conference'):
+    """Return composite indexes for kind declared in index.yaml at path."""
+    with open(path) as f:
+        config = yaml.safe_load(f) or {}
+    return [tuple(p['name'] for p in index.get('properties', []))
+            for index in config.get('indexes') or []
+            if index.get('kind') == kind]
+
+
+def _valueCount(conf, field):
+    """Return number of index values conf has for field."""
+    value = getattr(conf, field, None)
+    if isinstance(value, list):
+        return len(value)
+    return 1
+
+
+def indexRows(indexes, conf):
+    """Return composite index rows written for conf; a repeated property
+    multiplies the rows of every index it appears in."""
+    rows = 0
+    for index in indexes:
+        product = 1
+        for field in index:
+            product *= _valueCount(conf, field)
+        rows += product
+    return rows
+
+
+def toYaml(indexes, kind='Conference'):
+    """Return index.yaml entries for indexes."""
+    return yaml.safe_dump(
+        [{'kind': kind, 'properties': [{'name': field} for field in index]}
+         for index in indexes], default_flow_style=False)
+
+
+def report(shapes, current, sample):
+    """Return plain-text report comparing current indexes with the
+    covering set for shapes, over a sample of Conferences."""
+    recommended = coveringIndexes(shapes)
+    lines = ['%d query shapes recorded' % len(shapes)]
+    for equalities, inequality in shapes:
+        if not isServed(equalities, inequality, current):
+            lines.append('  NOT SERVED by current indexes: %s' %
+                         shapeId(equalities, inequality))
+
+    lines.append('current: %d composite indexes, recommended: %d' %
+                 (len(current), len(recommended)))
+    if sample:
+        before = sum(indexRows(current, conf) for conf in sample)
+        after = sum(indexRows(recommended, conf) for conf in sample)
+        lines.append('composite index rows per Conference.put() '
+                     '(mean of %d): %.1f before, %.1f after' %
+                     (len(sample), float(before) / len(sample),
+                      float(after) / len(sample)))
+    unused = [index for index in current if index not in recommended]
+    if unused:
+        lines.append('not needed by any recorded shape '
+                     '(projection queries are not recorded):')
+        lines.extend('  %s' % ', '.join(index) for index in unused)
+    lines.append('')
+    lines.append('recommended index.yaml entries:')
+    lines.append(toYaml(recommended))
+    return '\n'.join(lines)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""
+keycache.py -- per-instance LRU caches of ndb.Key <-> websafe key string
+    conversions, which otherwise redo base64 & protobuf work every time
+
+"""
+
+import threading
+from collections import OrderedDict
+
+from google.appengine.ext import ndb
+
+KEY_CACHE_SIZE = 10000
+
+
+class LRUCache(object):
+    """Bounded, thread-safe least-recently-used cache with hit counters."""
+
+    def __init__(self, size):
+        self._size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key, compute):
+        """Return cached value for key, computing & caching it on a miss."""
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+            else:
+                self._items[key] = value    # now most recently used
+                self.hits += 1
+                return value
+        # compute outside the lock; errors are not cached
+        value = compute(key)
+        with self._lock:
+            self._items[key] = value
+            if len(self._items) > self._size:
+                self._items.popitem(last=False)
+        return value
+
+
+    def stats(self):
+        """Return dict of size, hits, misses & hit rate."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._items), 'hits': self.hits,
+                    'misses': self.misses,
+                    'hitRate': float(self.hits) / lookups if lookups else 0.0}
+
+
+_decoded = LRUCache(KEY_CACHE_SIZE)
+_encoded = LRUCache(KEY_CACHE_SIZE)
+
+
+def keyFromUrlsafe(websafeKey):
+    """Return ndb.Key for websafe key string."""
+    return _decoded.get(websafeKey, lambda wsk: ndb.Key(urlsafe=wsk))
+
+
+def urlsafeFromKey(key):
+    """Return websafe string for ndb.Key."""
+    return _encoded.get(key, lambda k: k.urlsafe())
+
+
+def stats():
+    """Return hit counters for both directions."""
+    return {'decode': _decoded.stats(), 'encode': _encoded.stats()}
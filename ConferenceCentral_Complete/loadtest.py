@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+"""
+loadtest.py -- registration contention harness; runs many simulated users
+    registering concurrently for a few conferences against the App Engine
+    testbed stubs (datastore, memcache, task queue), then reports
+    throughput, latency, transaction retries & seat consistency
+
+Needs only the App Engine Python SDK, no live services:
+
+    python loadtest.py --sdk ~/google_appengine --users 5000 \\
+        --conferences 4 --organizers 1 --seats 500 --threads 50
+
+--organizers sets fan-in: conferences are spread over that many organizer
+Profiles, so fewer organizers put more conferences in each entity group.
+Conferences of SEAT_SHARD_THRESHOLD seats or more get sharded seats.
+The stubs run in one process, so absolute numbers are a lower bound;
+compare runs (fan-in, sharding, seats) against each other.
+
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from Queue import Queue
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1].strip())
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='App Engine Python SDK directory')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--conferences', type=int, default=4)
+    parser.add_argument('--organizers', type=int, default=1,
+                        help='organizer Profiles the conferences are spread over')
+    parser.add_argument('--seats', type=int, default=500,
+                        help='maxAttendees of every conference')
+    parser.add_argument('--threads', type=int, default=50,
+                        help='users registering at once')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def setUpSdk(sdk):
+    """Put the SDK & its bundled libraries on sys.path."""
+    if sdk:
+        sys.path.insert(0, sdk)
+    try:
+        import dev_appserver
+    except ImportError:
+        sys.exit('App Engine Python SDK not found; pass --sdk or set APPENGINE_SDK.')
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, HERE)
+
+
+def activateTestbed():
+    """Return active testbed with the stubs registration touches."""
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    # every write applied at once, so seat checks see what they would in HRD
+    bed.init_datastore_v3_stub(consistency_policy=
+        datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=HERE)
+    bed.init_user_stub()
+    bed.init_app_identity_stub()
+    return bed
+
+
+class SimulatedUsers(object):
+    """Per-thread current user, standing in for endpoints' OAuth lookup."""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def set(self, email):
+        self._local.email = email
+
+    def get_current_user(self):
+        from google.appengine.api import users
+        return users.User(email=self._local.email)
+
+
+def createConferences(api, simulated, args):
+    """Return websafe keys of the conferences, spread over organizers."""
+    from models import Conference
+    from models import ConferenceForm
+
+    for i in range(args.conferences):
+        simulated.set('organizer%d@example.com' % (i % args.organizers))
+        api._createConferenceObject(ConferenceForm(
+            name='Load test %d' % i, maxAttendees=args.seats))
+    # the returned form has no websafeKey, so read the keys back
+    return [conf.key.urlsafe() for conf in Conference.query()]
+
+
+def register(api, simulated, request_class, jobs, results):
+    """Worker: register users from jobs until it is empty."""
+    from google.appengine.ext import ndb
+    from models import ConflictException
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        email, wsck = job
+        simulated.set(email)
+        ndb.get_context().clear_cache()     # a fresh request each time
+        start = time.time()
+        try:
+            api._conferenceRegistration(request_class(websafeConferenceKey=wsck))
+            outcome = 'registered'
+        except ConflictException:
+            outcome = 'rejected'
+        except Exception as e:
+            outcome = 'error: %s' % type(e).__name__
+        results.append((outcome, time.time() - start))
+
+
+def percentile(sorted_values, fraction):
+    """Return value at fraction of sorted_values (nearest rank)."""
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def seatReport(api, wscks, seats):
+    """Return lines comparing seats taken with Registrations per conference."""
+    from google.appengine.ext import ndb
+    from models import Registration
+
+    lines = []
+    for wsck in wscks:
+        conf = ndb.Key(urlsafe=wsck).get()
+        if conf.seatShards:
+            shards = ndb.get_multi(api._seatShardKeys(conf.key, conf.seatShards))
+            available = sum(shard.seatsAvailable for shard in shards if shard)
+        else:
+            available = conf.seatsAvailable
+        registered = Registration.query(Registration.conferenceKey == conf.key).count()
+        consistent = available + registered == seats and available >= 0
+        lines.append('  %s: %d registered, %d available, %s%s' % (
+            conf.name, registered, available,
+            'consistent' if consistent else 'INCONSISTENT',
+            ' (sharded)' if conf.seatShards else ''))
+    return lines
+
+
+def main(argv):
+    args = parseArgs(argv)
+    setUpSdk(args.sdk)
+    bed = activateTestbed()
+    random.seed(args.seed)
+
+    import endpoints
+    import conference
+    import txstats
+
+    simulated = SimulatedUsers()
+    endpoints.get_current_user = simulated.get_current_user
+    api = conference.ConferenceApi()
+    request_class = conference.CONF_MUTATE_REQUEST.combined_message_class
+
+    wscks = createConferences(api, simulated, args)
+
+    jobs = Queue()
+    for i in range(args.users):
+        jobs.put(('user%d@example.com' % i, random.choice(wscks)))
+    for _ in range(args.threads):
+        jobs.put(None)
+    results = []
+    workers = [threading.Thread(target=register,
+                                args=(api, simulated, request_class, jobs, results))
+               for _ in range(args.threads)]
+
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+
+    latencies = sorted(latency for outcome, latency in results)
+    outcomes = {}
+    for outcome, latency in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    stats = [row for row in txstats.report()
+             if row['transaction'] == 'conferenceRegistration']
+
+    print '%d users, %d conferences of %d seats, %d organizers, %d threads' % (
+        args.users, args.conferences, args.seats, args.organizers, args.threads)
+    print 'elapsed %.2fs, %.1f registration calls/s' % (elapsed, len(results) / elapsed)
+    print 'outcomes: %s' % ', '.join('%s %d' % item for item in sorted(outcomes.items()))
+    print 'latency ms: p50 %.1f, p99 %.1f, max %.1f' % (
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+        (latencies[-1] if latencies else 0) * 1000)
+    print 'transactions: %d attempts, %d retries, %d aborts' % (
+        sum(row['attempts'] for row in stats), sum(row['retries'] for row in stats),
+        sum(row['aborts'] for row in stats))
+    for row in stats:
+        print '  organizer %s: %d calls, %d retries, %d aborts, commit %.1fms' % (
+            row['group'], row['calls'], row['retries'], row['aborts'],
+            row['meanCommitMs'])
+    print 'seats:'
+    print '\n'.join(seatReport(api, wscks, args.seats))
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
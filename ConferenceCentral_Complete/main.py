@@ -12,10 +12,37 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
+import os
+
+import endpoints
 import webapp2
+from protorpc import messages
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from conference import ConferenceApi
+from conference import MEMCACHE_CONFERENCES_GENERATION_KEY
+from conference import filterEngine
+from models import Conference
+from models import ConferenceForms
+from models import ConferenceQueryForms
+from models import QueryShape
+from settings import USE_FILTER_ENGINE
+from utils import getUserId
+import indexadvisor
+import keycache
+import txstats
+import streaming
+
+# one-off tasks started by /admin/backfill
+BACKFILL_TASK_URLS = [
+    '/tasks/backfill_organizer_display_names',
+    '/tasks/recount_facets',
+    '/tasks/backfill_registrations',
+]
+
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
@@ -24,6 +51,30 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
         self.response.set_status(204)
 
 
+class ExpireIdempotencyRecordsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Delete IdempotencyRecords past their retention."""
+        ConferenceApi._expireIdempotencyRecords()
+        self.response.set_status(204)
+
+
+class ReleaseSeatHoldsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Give back seats of expired seat holds."""
+        ConferenceApi._releaseExpiredHolds()
+        self.response.set_status(204)
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        """Build the filter engine's index before the instance serves
+        user requests."""
+        if USE_FILTER_ENGINE:
+            filterEngine.refresh(memcache.get(MEMCACHE_CONFERENCES_GENERATION_KEY)
+                                 or ConferenceApi._initConferencesGeneration())
+        self.response.set_status(204)
+
+
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
         """Send email confirming Conference creation."""
@@ -38,7 +89,167 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
         )
 
 
+class UpdateOrganizerDisplayNameHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy organizer displayName to their Conferences."""
+        ConferenceApi._updateOrganizerDisplayName(
+            self.request.get('organizerUserId'),
+            self.request.get('websafeCursor') or None)
+
+
+class BackfillOrganizerDisplayNamesHandler(webapp2.RequestHandler):
+    def post(self):
+        """Fill organizerDisplayName of Conferences written before it was stored."""
+        ConferenceApi._backfillOrganizerDisplayNames(
+            self.request.get('websafeCursor') or None)
+
+
+class BackfillRegistrationsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Move legacy conferenceKeysToAttend lists into Registrations."""
+        ConferenceApi._backfillRegistrations(
+            self.request.get('websafeCursor') or None)
+
+
+class UpdateFacetCountsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Apply Conference facet count changes."""
+        ConferenceApi._updateFacetCounts(self.request.get('deltas'),
+                                         self.request.get('change'))
+
+
+class RecountFacetsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Set Conference facet counts from scratch."""
+        ConferenceApi._recountFacets()
+
+
+class SyncSeatsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy SeatShard total to Conference.seatsAvailable."""
+        ConferenceApi._syncSeats(self.request.get('websafeConferenceKey'))
+
+
+class AdjustSeatShardsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Apply maxAttendees change to SeatShards."""
+        ConferenceApi._adjustSeatShards(
+            self.request.get('websafeConferenceKey'),
+            int(self.request.get('delta')),
+            int(self.request.get('version')))
+
+
+class DrainRegistrationClaimsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Apply a batch of queued registration claims."""
+        ConferenceApi._drainRegistrationClaims(
+            self.request.get('websafeConferenceKey'))
+
+
+class PromoteWaitlistHandler(webapp2.RequestHandler):
+    def post(self):
+        """Register waitlisted users as seats allow."""
+        ConferenceApi._promoteWaitlist(self.request.get('websafeConferenceKey'))
+
+
+class IndexAdvisorHandler(webapp2.RequestHandler):
+    def get(self):
+        """Report composite indexes needed by recorded query shapes."""
+        shapes = [(shape.equalities, shape.inequality)
+                  for shape in QueryShape.query()]
+        current = indexadvisor.loadIndexes(
+            os.path.join(os.path.dirname(__file__), 'index.yaml'))
+        sample = Conference.query().fetch(100)
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write(indexadvisor.report(shapes, current, sample))
+
+
+class KeyCacheStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Report this instance's websafe key cache hit rates."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(keycache.stats()))
+
+
+class BackfillHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start the one-off tasks that fill data written before newer
+        fields & entities existed; each task is safe to run again."""
+        for url in BACKFILL_TASK_URLS:
+            taskqueue.add(url=url)
+        self.response.set_status(204)
+
+
+class TransactionStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Report transaction attempts, retries & collisions per entity
+        group, most contended first."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(txstats.report(), indent=1))
+
+
+class StreamHandler(webapp2.RequestHandler):
+    def stream(self, page, container):
+        """Send a page of forms as container message, encoded chunk by
+        chunk as protobuf if the client accepts it, else JSON
+        {"items": [...], "nextPageToken": ...}. The runtime sends the body
+        only once it is complete, so pages keep it bounded."""
+        forms, next_page_token = page
+        if streaming.wantsProtobuf(self.request):
+            self.response.headers['Content-Type'] = streaming.PROTOBUF_CONTENT_TYPE
+            self.response.app_iter = streaming.protobufItemsChunks(
+                forms, container, next_page_token)
+        else:
+            self.response.headers['Content-Type'] = streaming.JSON_CONTENT_TYPE
+            self.response.app_iter = streaming.jsonItemsChunks(forms, next_page_token)
+
+
+class StreamConferencesCreatedHandler(StreamHandler):
+    def get(self):
+        """Stream a page of conferences created by user."""
+        user = streaming.getCurrentUser()
+        if not user:
+            self.abort(401, detail='Authorization required')
+        try:
+            self.stream(ConferenceApi()._streamConferencesCreated(
+                getUserId(user), self.request.get('pageToken') or None),
+                ConferenceForms)
+        except endpoints.ServiceException as e:
+            self.abort(e.http_status, detail=str(e))
+
+
+class StreamQueryConferencesHandler(StreamHandler):
+    def post(self):
+        """Stream a page of conferences matching ConferenceQueryForms body."""
+        try:
+            request = streaming.decodeMessage(ConferenceQueryForms, self.request)
+            self.stream(ConferenceApi()._streamQueryConferences(request),
+                        ConferenceForms)
+        except messages.Error as e:
+            self.abort(400, detail=str(e))
+        except endpoints.ServiceException as e:
+            self.abort(e.http_status, detail=str(e))
+
+
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/release_seat_holds', ReleaseSeatHoldsHandler),
+    ('/crons/expire_idempotency_records', ExpireIdempotencyRecordsHandler),
+    ('/_ah/warmup', WarmupHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
+    ('/tasks/update_organizer_display_name', UpdateOrganizerDisplayNameHandler),
+    ('/tasks/update_facet_counts', UpdateFacetCountsHandler),
+    ('/tasks/recount_facets', RecountFacetsHandler),
+    ('/tasks/backfill_organizer_display_names', BackfillOrganizerDisplayNamesHandler),
+    ('/tasks/backfill_registrations', BackfillRegistrationsHandler),
+    ('/tasks/sync_seats', SyncSeatsHandler),
+    ('/tasks/adjust_seat_shards', AdjustSeatShardsHandler),
+    ('/tasks/drain_registration_claims', DrainRegistrationClaimsHandler),
+    ('/tasks/promote_waitlist', PromoteWaitlistHandler),
+    ('/admin/index_advisor', IndexAdvisorHandler),
+    ('/admin/key_cache_stats', KeyCacheStatsHandler),
+    ('/admin/backfill', BackfillHandler),
+    ('/admin/transaction_stats', TransactionStatsHandler),
+    ('/stream/getConferencesCreated', StreamConferencesCreatedHandler),
+    ('/stream/queryConferences', StreamQueryConferencesHandler),
 ], debug=True)
@@ -26,7 +26,12 @@ class Profile(ndb.Model):
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
-    conferenceKeysToAttend = ndb.StringProperty(repeated=True)
+    conferenceKeysToAttend = ndb.StringProperty(repeated=True) # legacy; see Registration
+
+class Registration(ndb.Model):
+    """Registration -- user's registration for a Conference; child of the
+    user's Profile, keyed by websafe Conference key"""
+    conferenceKey = ndb.KeyProperty(kind='Conference')
 
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
@@ -53,6 +58,7 @@ class Conference(ndb.Model):
     name            = ndb.StringProperty(required=True)
     description     = ndb.StringProperty()
     organizerUserId = ndb.StringProperty()
+    organizerDisplayName = ndb.StringProperty(indexed=False) # copy of Profile.displayName
     topics          = ndb.StringProperty(repeated=True)
     city            = ndb.StringProperty()
     startDate       = ndb.DateProperty()
@@ -60,6 +66,40 @@ class Conference(ndb.Model):
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    version         = ndb.IntegerProperty(indexed=False, default=0) # bumped on every write
+    seatShards      = ndb.IntegerProperty(indexed=False, default=0) # 0: seats kept here
+    modified        = ndb.DateTimeProperty(auto_now=True) # filter engine refreshes
+
+class IdempotencyRecord(ndb.Model):
+    """IdempotencyRecord -- recorded outcome of a mutation sent with an
+    idempotency key; child of the user's Profile"""
+    result  = ndb.BooleanProperty(indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+class RegistrationClaim(ndb.Model):
+    """RegistrationClaim -- queued request for a seat; keyed
+    "<websafeConferenceKey>:<userId>" so a user has one per conference"""
+    conferenceKey = ndb.KeyProperty(kind='Conference', indexed=False)
+    userId        = ndb.StringProperty(indexed=False)
+    status        = ndb.StringProperty(indexed=False, default='PENDING')
+    batchId       = ndb.StringProperty(indexed=False) # ClaimBatch taking its seat
+    created       = ndb.DateTimeProperty(indexed=False, auto_now_add=True)
+
+class ClaimBatch(ndb.Model):
+    """ClaimBatch -- record of seats taken for one batch of claims or
+    waitlist promotions, so a retried batch never takes them twice"""
+    granted = ndb.StringProperty(repeated=True, indexed=False) # claim/user ids
+
+class WaitlistEntry(ndb.Model):
+    """WaitlistEntry -- user waiting for a seat at a sold out Conference;
+    child of the user's Profile, keyed by websafe Conference key"""
+    conferenceKey = ndb.KeyProperty(kind='Conference')
+    created       = ndb.DateTimeProperty(auto_now_add=True)
+
+class SeatShard(ndb.Model):
+    """SeatShard -- one slice of a sharded Conference's available seats"""
+    seatsAvailable  = ndb.IntegerProperty(indexed=False, default=0)
+    adjustments     = ndb.StringProperty(repeated=True, indexed=False)
 
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
@@ -75,10 +115,90 @@ class ConferenceForm(messages.Message):
     endDate         = messages.StringField(10) #DateTimeField()
     websafeKey      = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    etag            = messages.StringField(13)
+    notModified     = messages.BooleanField(14) # only websafeKey & etag set
 
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+class ConferenceSummaryForm(messages.Message):
+    """ConferenceSummaryForm -- Conference list-view outbound form message"""
+    name            = messages.StringField(1)
+    city            = messages.StringField(2)
+    startDate       = messages.StringField(3)
+    endDate         = messages.StringField(4)
+    maxAttendees    = messages.IntegerField(5, variant=messages.Variant.INT32)
+    seatsAvailable  = messages.IntegerField(6, variant=messages.Variant.INT32)
+    websafeKey      = messages.StringField(7)
+
+class ConferenceSummaryForms(messages.Message):
+    """ConferenceSummaryForms -- multiple ConferenceSummaryForm outbound form message"""
+    items = messages.MessageField(ConferenceSummaryForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+class ConferenceFacet(ndb.Model):
+    """ConferenceFacet -- running count of Conferences per facet value"""
+    field           = ndb.StringProperty()
+    value           = ndb.StringProperty()
+    count           = ndb.IntegerProperty(default=0)
+    applied         = ndb.StringProperty(repeated=True, indexed=False)
+
+class QueryShape(ndb.Model):
+    """QueryShape -- Conference query shape seen by queryConferences()"""
+    equalities      = ndb.StringProperty(repeated=True)
+    inequality      = ndb.StringProperty()
+
+class FacetValueForm(messages.Message):
+    """FacetValueForm -- count of Conferences with one facet value"""
+    value = messages.StringField(1)
+    count = messages.IntegerField(2, variant=messages.Variant.INT32)
+
+class FacetForm(messages.Message):
+    """FacetForm -- value counts for one facet field"""
+    field = messages.StringField(1)
+    values = messages.MessageField(FacetValueForm, 2, repeated=True)
+
+class FacetForms(messages.Message):
+    """FacetForms -- multiple FacetForm outbound form message"""
+    facets = messages.MessageField(FacetForm, 1, repeated=True)
+
+class ClaimStatus(messages.Enum):
+    """ClaimStatus -- queued registration claim status enumeration value"""
+    PENDING = 1
+    REGISTERED = 2
+    REJECTED = 3
+
+class ClaimForm(messages.Message):
+    """ClaimForm -- queued registration claim outbound form message"""
+    websafeConferenceKey = messages.StringField(1)
+    status = messages.EnumField('ClaimStatus', 2)
+
+class HoldForm(messages.Message):
+    """HoldForm -- seat hold outbound form message"""
+    websafeConferenceKey = messages.StringField(1)
+    expires = messages.StringField(2) # UTC, ISO 8601
+
+class BulkRegistrationForm(messages.Message):
+    """BulkRegistrationForm -- organizer's list of attendees to register"""
+    userIds = messages.StringField(1, repeated=True)
+    importId = messages.StringField(2) # same id on retry: no seat taken twice
+
+class RegistrationOutcome(messages.Enum):
+    """RegistrationOutcome -- bulk registration outcome enumeration value"""
+    REGISTERED = 1
+    ALREADY_REGISTERED = 2
+    NO_SEAT = 3
+
+class RegistrationResultForm(messages.Message):
+    """RegistrationResultForm -- one attendee's bulk registration outcome"""
+    userId = messages.StringField(1)
+    outcome = messages.EnumField('RegistrationOutcome', 2)
+
+class RegistrationResultForms(messages.Message):
+    """RegistrationResultForms -- multiple RegistrationResultForm outbound form message"""
+    items = messages.MessageField(RegistrationResultForm, 1, repeated=True)
 
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
@@ -103,8 +223,12 @@ class ConferenceQueryForm(messages.Message):
     field = messages.StringField(1)
     operator = messages.StringField(2)
     value = messages.StringField(3)
+    values = messages.StringField(4, repeated=True) # for IN operator
 
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(3)
+    fields = messages.StringField(4, repeated=True) # ConferenceForm fields to return
 
@@ -16,3 +16,7 @@ WEB_CLIENT_ID = 'replace with Web client ID'
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Answer queryConferences() from a per-instance in-memory index instead of
+# datastore queries; lifts the one-inequality-field restriction.
+USE_FILTER_ENGINE = False
@@ -270,7 +270,8 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
         {enumValue: 'CITY', displayName: 'City'},
         {enumValue: 'TOPIC', displayName: 'Topic'},
         {enumValue: 'MONTH', displayName: 'Start month'},
-        {enumValue: 'MAX_ATTENDEES', displayName: 'Max Attendees'}
+        {enumValue: 'MAX_ATTENDEES', displayName: 'Max Attendees'},
+        {enumValue: 'SEATS_AVAILABLE', displayName: 'Seats Available'}
     ]
 
     /**
@@ -284,7 +285,8 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
         {displayName: '>=', enumValue: 'GTEQ'},
         {displayName: '<', enumValue: 'LT'},
         {displayName: '<=', enumValue: 'LTEQ'},
-        {displayName: '!=', enumValue: 'NE'}
+        {displayName: '!=', enumValue: 'NE'},
+        {displayName: 'in (a, b, ...)', enumValue: 'IN'}
     ];
 
     /**
@@ -346,15 +348,59 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     $scope.pagination = $scope.pagination || {};
     $scope.pagination.currentPage = 0;
     $scope.pagination.pageSize = 20;
+
+    /**
+     * Holds the pageToken for each page of the 'ALL' tab discovered so far; the 'ALL' tab is paged
+     * on the server, so only the current page of conferences is held in $scope.conferences.
+     * @type {Array}
+     */
+    $scope.pagination.pageTokens = [null];
+
+    /**
+     * Returns if the conferences are paged on the server side.
+     *
+     * @returns {boolean}
+     */
+    $scope.pagination.isServerSide = function () {
+        return $scope.selectedTab == 'ALL';
+    };
+
     /**
      * Returns the number of the pages in the pagination.
      *
      * @returns {number}
      */
     $scope.pagination.numberOfPages = function () {
+        if ($scope.pagination.isServerSide()) {
+            return $scope.pagination.pageTokens.length;
+        }
         return Math.ceil($scope.conferences.length / $scope.pagination.pageSize);
     };
 
+    /**
+     * Returns the index in $scope.conferences of the first conference of the current page.
+     *
+     * @returns {number}
+     */
+    $scope.pagination.offset = function () {
+        if ($scope.pagination.isServerSide()) {
+            return 0;
+        }
+        return $scope.pagination.currentPage * $scope.pagination.pageSize;
+    };
+
+    /**
+     * Moves to the page specified, fetching it from the server if the conferences are paged on the server side.
+     *
+     * @param page
+     */
+    $scope.pagination.goToPage = function (page) {
+        $scope.pagination.currentPage = page;
+        if ($scope.pagination.isServerSide()) {
+            $scope.queryConferencesAll(page);
+        }
+    };
+
     /**
      * Returns an array including the numbers from 1 to the number of the pages.
      *
@@ -414,8 +460,10 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.queryConferences = function () {
         $scope.submitted = false;
+        $scope.pagination.currentPage = 0;
         if ($scope.selectedTab == 'ALL') {
-            $scope.queryConferencesAll();
+            $scope.pagination.pageTokens = [null];
+            $scope.queryConferencesAll(0);
         } else if ($scope.selectedTab == 'YOU_HAVE_CREATED') {
             $scope.getConferencesCreated();
         } else if ($scope.selectedTab == 'YOU_WILL_ATTEND') {
@@ -424,20 +472,37 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     };
 
     /**
-     * Invokes the conference.queryConferences API.
+     * Invokes the conference.queryConferences API for a single page.
+     *
+     * @param page the index of the page to fetch; its pageToken must be in pagination.pageTokens.
      */
-    $scope.queryConferencesAll = function () {
+    $scope.queryConferencesAll = function (page) {
         var sendFilters = {
-            filters: []
+            filters: [],
+            pageSize: $scope.pagination.pageSize
+        }
+        if ($scope.pagination.pageTokens[page]) {
+            sendFilters.pageToken = $scope.pagination.pageTokens[page];
         }
         for (var i = 0; i < $scope.filters.length; i++) {
             var filter = $scope.filters[i];
             if (filter.field && filter.operator && filter.value) {
-                sendFilters.filters.push({
-                    field: filter.field.enumValue,
-                    operator: filter.operator.enumValue,
-                    value: filter.value
-                });
+                if (filter.operator.enumValue == 'IN') {
+                    // The comma-separated values are sent as a list.
+                    sendFilters.filters.push({
+                        field: filter.field.enumValue,
+                        operator: filter.operator.enumValue,
+                        values: filter.value.split(',').map(function (value) {
+                            return value.trim();
+                        })
+                    });
+                } else {
+                    sendFilters.filters.push({
+                        field: filter.field.enumValue,
+                        operator: filter.operator.enumValue,
+                        value: filter.value
+                    });
+                }
             }
         }
         $scope.loading = true;
@@ -462,6 +527,11 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         angular.forEach(resp.items, function (conference) {
                             $scope.conferences.push(conference);
                         });
+                        // Keep the pages discovered so far; a new page becomes reachable once its token is known.
+                        $scope.pagination.pageTokens.length = page + 1;
+                        if (resp.nextPageToken) {
+                            $scope.pagination.pageTokens.push(resp.nextPageToken);
+                        }
                     }
                     $scope.submitted = true;
                 });
@@ -506,12 +576,26 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     };
 
     /**
-     * Retrieves the conferences to attend by calling the conference.getProfile method and
-     * invokes the conference.getConference method n times where n == the number of the conferences to attend.
+     * Retrieves the conferences to attend by calling the conference.getConferencesToAttend method,
+     * following nextPageToken until all pages are fetched.
      */
     $scope.getConferencesAttend = function () {
         $scope.loading = true;
-        gapi.client.conference.getConferencesToAttend().
+        $scope.conferences = [];
+        $scope.getConferencesAttendPage(null);
+    };
+
+    /**
+     * Fetches one page of the conferences to attend and appends it to $scope.conferences.
+     *
+     * @param pageToken the nextPageToken of the previous page, or null for the first page.
+     */
+    $scope.getConferencesAttendPage = function (pageToken) {
+        var request = {pageSize: 100};
+        if (pageToken) {
+            request.pageToken = pageToken;
+        }
+        gapi.client.conference.getConferencesToAttend(request).
             execute(function (resp) {
                 $scope.$apply(function () {
                     if (resp.error) {
@@ -527,7 +611,13 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         }
                     } else {
                         // The request has succeeded.
-                        $scope.conferences = resp.result.items;
+                        angular.forEach(resp.result.items, function (conference) {
+                            $scope.conferences.push(conference);
+                        });
+                        if (resp.result.nextPageToken) {
+                            $scope.getConferencesAttendPage(resp.result.nextPageToken);
+                            return;
+                        }
                         $scope.loading = false;
                         $scope.messages = 'Query succeeded : Conferences you will attend (or you have attended)';
                         $scope.alertStatus = 'success';
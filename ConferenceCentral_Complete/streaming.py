@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""
+streaming.py -- helpers for list responses encoded item by item, so a
+    request never holds the list's forms and its encoding side by side;
+    JSON by default, binary protobuf for clients that ask for it
+
+The python27 runtime buffers the whole response before sending it, so
+chunking does not stream to the client and peak memory still grows with
+the encoded body. Lists are therefore sent STREAM_PAGE_SIZE items at a
+time, each response ending with a nextPageToken for the next one.
+
+"""
+
+import json
+
+import endpoints
+from protorpc import protobuf
+from protorpc import protojson
+from google.appengine.api import oauth
+
+from settings import WEB_CLIENT_ID
+from settings import ANDROID_CLIENT_ID
+from settings import IOS_CLIENT_ID
+
+STREAM_BATCH_SIZE = 100     # entities per datastore batch
+STREAM_CHUNK_SIZE = 32768   # bytes per response chunk
+STREAM_PAGE_SIZE = 1000     # items per response
+
+JSON_CONTENT_TYPE = 'application/json'
+PROTOBUF_CONTENT_TYPE = 'application/x-protobuf'
+
+ALLOWED_CLIENT_IDS = [WEB_CLIENT_ID, ANDROID_CLIENT_ID, IOS_CLIENT_ID,
+                      endpoints.API_EXPLORER_CLIENT_ID]
+
+
+def getCurrentUser():
+    """Return user authorized by the request's OAuth2 bearer token for
+    one of our client IDs, or None."""
+    try:
+        user = oauth.get_current_user(endpoints.EMAIL_SCOPE)
+        if oauth.get_client_id(endpoints.EMAIL_SCOPE) not in ALLOWED_CLIENT_IDS:
+            return None
+    except oauth.Error:
+        return None
+    return user
+
+
+def jsonItemsChunks(forms, next_page_token=None, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield JSON text of {"items": [...], "nextPageToken": ...} for forms,
+    in chunks of about chunk_size bytes, encoding each form as it comes."""
+    chunk = ['{"items": [']
+    size = 0
+    separator = ''
+    for form in forms:
+        item = protojson.encode_message(form)
+        chunk.append(separator + item)
+        separator = ','
+        size += len(item) + 1
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(']')
+    if next_page_token:
+        chunk.append(', "nextPageToken": %s' % json.dumps(next_page_token))
+    chunk.append('}')
+    yield ''.join(chunk)
+
+
+def protobufItemsChunks(forms, container, next_page_token=None,
+                        chunk_size=STREAM_CHUNK_SIZE):
+    """Yield binary protobuf of container(items=forms, nextPageToken=...)
+    in chunks of about chunk_size bytes; encoded messages concatenate, so
+    each form is encoded on its own as a one-item container."""
+    chunk = []
+    size = 0
+    for form in forms:
+        item = protobuf.encode_message(container(items=[form]))
+        chunk.append(item)
+        size += len(item)
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    if next_page_token:
+        chunk.append(protobuf.encode_message(container(nextPageToken=next_page_token)))
+    yield ''.join(chunk)
+
+
+def wantsProtobuf(request):
+    """Return True if webapp2 request's Accept header prefers protobuf."""
+    return request.accept.best_match(
+        [JSON_CONTENT_TYPE, PROTOBUF_CONTENT_TYPE]) == PROTOBUF_CONTENT_TYPE
+
+
+def decodeMessage(message_type, request):
+    """Decode webapp2 request body as protobuf or JSON, by Content-Type."""
+    if request.content_type == PROTOBUF_CONTENT_TYPE:
+        return protobuf.decode_message(message_type, request.body)
+    return protojson.decode_message(message_type, request.body)
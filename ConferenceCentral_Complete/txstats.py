@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""
+txstats.py -- attempt, retry, collision & commit time counters for ndb
+    transactions, kept in memcache per (transaction, entity group) so
+    every instance adds to the same totals
+
+"""
+
+import functools
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+MEMCACHE_GROUPS_KEY = "TXSTATS_GROUPS"
+MEMCACHE_PREFIX_TPL = "TXSTATS:%s:%s:"
+MAX_GROUPS = 1000           # (transaction, group) pairs reported
+METRICS = ('calls', 'attempts', 'retries', 'collisions', 'aborts',
+           'commits', 'commitMicros')
+
+# (transaction, group) pairs already registered by this instance
+_registered = set()
+
+
+def transactional(name, group, **options):
+    """Like @ndb.transactional(**options), also recording each call under
+    name & the entity group label group(*args, **kwds) returns. Calls
+    made inside another transaction are not recorded."""
+    def decorator(func):
+        txn_func = ndb.transactional(**options)(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwds):
+            if ndb.in_transaction():
+                return txn_func(*args, **kwds)
+            state = {'attempts': 0, 'returned': None, 'committed': None}
+
+            def committed():
+                state['committed'] = time.time()
+
+            def attempt():
+                state['attempts'] += 1
+                state['returned'] = None
+                # registered first, so it runs before func's own
+                # on-commit callbacks and they aren't timed as commit
+                ndb.get_context().call_on_commit(committed)
+                result = func(*args, **kwds)
+                state['returned'] = time.time()
+                return result
+
+            try:
+                result = ndb.transactional(**options)(attempt)()
+            except datastore_errors.TransactionFailedError:
+                record(name, _label(group, args, kwds), state['attempts'], aborted=True)
+                raise
+            except Exception:
+                # raised by func itself: attempts so far still count
+                record(name, _label(group, args, kwds), state['attempts'])
+                raise
+            record(name, _label(group, args, kwds), state['attempts'],
+                   commit_seconds=state['committed'] - state['returned'])
+            return result
+        return wrapper
+    return decorator
+
+
+def _label(group, args, kwds):
+    """Return group label for a call; a bad argument that made the call
+    fail must not hide its error."""
+    try:
+        return group(*args, **kwds)
+    except Exception:
+        return 'unknown'
+
+
+def record(name, group, attempts, commit_seconds=None, aborted=False):
+    """Add one transaction call's outcome to the counters. Every retry
+    follows a collision at commit; an abort is a collision on the last
+    attempt."""
+    retries = max(attempts - 1, 0)
+    deltas = {'calls': 1, 'attempts': attempts, 'retries': retries,
+              'collisions': retries + (1 if aborted else 0),
+              'aborts': 1 if aborted else 0}
+    if commit_seconds is not None:
+        deltas['commits'] = 1
+        deltas['commitMicros'] = int(commit_seconds * 1000000)
+    _register(name, group)
+    memcache.offset_multi(deltas, key_prefix=MEMCACHE_PREFIX_TPL % (name, group),
+                          initial_value=0)
+
+
+def _register(name, group):
+    """Add (name, group) to the memcache list report() reads, once per
+    instance."""
+    pair = (name, group)
+    if pair in _registered:
+        return
+    client = memcache.Client()
+    for _ in range(3):
+        groups = client.gets(MEMCACHE_GROUPS_KEY)
+        if groups is None:
+            if client.add(MEMCACHE_GROUPS_KEY, [pair]):
+                break
+            continue
+        if pair in groups or len(groups) >= MAX_GROUPS:
+            break
+        if client.cas(MEMCACHE_GROUPS_KEY, groups + [pair]):
+            break
+    _registered.add(pair)
+
+
+def report():
+    """Return list of counter dicts, one per (transaction, group), most
+    collisions first."""
+    rows = []
+    for name, group in memcache.get(MEMCACHE_GROUPS_KEY) or []:
+        counts = memcache.get_multi(METRICS,
+            key_prefix=MEMCACHE_PREFIX_TPL % (name, group))
+        row = dict((metric, int(counts.get(metric, 0))) for metric in METRICS)
+        row.update(transaction=name, group=group)
+        micros = row.pop('commitMicros')
+        row['meanCommitMs'] = micros / 1000.0 / row['commits'] if row['commits'] else 0.0
+        rows.append(row)
+    rows.sort(key=lambda row: (-row['collisions'], -row['attempts']))
+    return rows